@@ -1,2 +1,3 @@
 from .tts import ChatterboxTTS
 from .vc import ChatterboxVC
+from .voice_bank import VoiceBank
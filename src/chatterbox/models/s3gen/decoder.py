@@ -11,6 +11,9 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from dataclasses import dataclass
+from typing import List
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -33,6 +36,27 @@ def mask_to_bias(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
     return mask
 
 
+@dataclass
+class DecoderContext:
+    """
+    The inputs of `ConditionalDecoder.forward` that do not change over the steps of an ODE solve, where only
+    `x` and `t` change. See `ConditionalDecoder.prepare_solve_context`.
+    """
+    # padding mask of every down level, (B, 1, T / 2**i); the mid blocks use the last one
+    masks: List[torch.Tensor]
+    # attention bias of every down level, (B, 1, T / 2**i); the up blocks reuse them in reverse
+    attn_biases: List[torch.Tensor]
+    # `mu`, the repeated `spks` and `cond`, packed along the channels as they follow `x`
+    static: torch.Tensor
+
+    def narrow(self, n: int) -> "DecoderContext":
+        "The context of the first `n` rows of the batch, e.g. of the conditional rows only."
+        return DecoderContext(
+            masks=[mask[:n] for mask in self.masks],
+            attn_biases=[attn_bias[:n] for attn_bias in self.attn_biases],
+            static=self.static[:n],
+        )
+
 
 class Transpose(torch.nn.Module):
     def __init__(self, dim0: int, dim1: int):
@@ -216,6 +240,10 @@ class ConditionalDecoder(nn.Module):
         self.final_proj = nn.Conv1d(channels[-1], self.out_channels, 1)
         self.initialize_weights()
 
+        # time embeddings of the fixed ODE grids, see `get_time_embedding_lut`
+        self.time_emb_cache = {}
+        self._register_load_state_dict_pre_hook(lambda *args, **kwargs: self.time_emb_cache.clear())
+
     def initialize_weights(self):
         for m in self.modules():
             if isinstance(m, nn.Conv1d):
@@ -230,7 +258,49 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None):
+    def embed_time(self, t):
+        "The timestep conditioning of the resnet blocks, shape (batch_size, time_embed_dim)."
+        t = self.time_embeddings(t).to(t.dtype)
+        return self.time_mlp(t)
+
+    def get_time_embedding_lut(self, t_span, key):
+        """
+        The time embeddings of every t of `t_span`, shape (len(t_span), time_embed_dim), cached under `key`. With
+        a fixed t-schedule, `key` = (n_timesteps, t_scheduler, dtype, device) identifies `t_span`, so the
+        embeddings are computed once and served by step index. Nothing is cached in training mode, where
+        the weights change between calls.
+        """
+        if self.training:
+            return self.embed_time(t_span)
+        lut = self.time_emb_cache.get(key)
+        if lut is None:
+            lut = self.time_emb_cache[key] = self.embed_time(t_span)
+        return lut
+
+    def prepare_solve_context(self, mask, mu, spks=None, cond=None) -> DecoderContext:
+        """
+        Compute the step-invariant inputs of `forward` once per ODE solve: the masks and attention biases of
+        every level (with a single host sync per level, in `add_optional_chunk_mask`), and the packed conditioning
+        channels. Same args as `forward`.
+        """
+        static = [mu]
+        if spks is not None:
+            static.append(repeat(spks, "b c -> b c t", t=mu.shape[-1]))
+        if cond is not None:
+            static.append(cond)
+        static = pack(static, "b * t")[0]
+
+        masks, attn_biases = [], []
+        mask_down = mask
+        for _ in self.down_blocks:
+            # attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
+            attn_mask = add_optional_chunk_mask(mask_down.transpose(1, 2), mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
+            masks.append(mask_down)
+            attn_biases.append(mask_to_bias(attn_mask == 1, mu.dtype))
+            mask_down = mask_down[:, :, ::2]
+        return DecoderContext(masks=masks, attn_biases=attn_biases, static=static)
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, context: DecoderContext = None, t_emb=None):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -239,6 +309,9 @@ class ConditionalDecoder(nn.Module):
             t (_type_): shape (batch_size)
             spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
             cond (_type_, optional): placeholder for future use. Defaults to None.
+            context (DecoderContext, optional): the output of `prepare_solve_context` for these `mask`, `mu`,
+                `spks` and `cond`, to reuse over the steps of a solve. Computed here if None.
+            t_emb (torch.Tensor, optional): `embed_time(t)`, e.g. from `get_time_embedding_lut`. Computed here if None.
 
         Raises:
             ValueError: _description_
@@ -247,27 +320,19 @@ class ConditionalDecoder(nn.Module):
         Returns:
             _type_: _description_
         """
+        if context is None:
+            context = self.prepare_solve_context(mask, mu, spks, cond)
 
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
+        t = self.embed_time(t) if t_emb is None else t_emb
 
-        x = pack([x, mu], "b * t")[0]
-
-        if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
-        if cond is not None:
-            x = pack([x, cond], "b * t")[0]
+        x = pack([x, context.static], "b * t")[0]
 
         hiddens = []
-        masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
+        for (resnet, transformer_blocks, downsample), mask_down, attn_mask in zip(
+            self.down_blocks, context.masks, context.attn_biases
+        ):
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -277,16 +342,11 @@ class ConditionalDecoder(nn.Module):
             x = rearrange(x, "b t c -> b c t").contiguous()
             hiddens.append(x)  # Save hidden states for skip connections
             x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
-        mask_mid = masks[-1]
+        mask_mid, attn_mask = context.masks[-1], context.attn_biases[-1]
 
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_mid.transpose(1, 2).contiguous(), mask_mid)
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -295,15 +355,13 @@ class ConditionalDecoder(nn.Module):
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
 
-        for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
+        for (resnet, transformer_blocks, upsample), mask_up, attn_mask in zip(
+            self.up_blocks, reversed(context.masks), reversed(context.attn_biases)
+        ):
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_up.transpose(1, 2).contiguous(), mask_up)
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -193,6 +193,25 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         # FIXME: this was missing - just putting it in as false
         self.fp16 = False
 
+    def prepare_prompt(self, prompt_feat, prompt_feat_len, embedding):
+        """
+        The parts of the decoder inputs that only depend on the reference: the projected x-vector (B, 80) and
+        the prompt frames of the conds (B, 80, T), zeroed past `prompt_feat_len`.
+        """
+        cond = prompt_feat
+        spks = embedding
+        if self.fp16 is True:
+            cond = cond.half()
+            spks = spks.half()
+
+        # xvec projection
+        spks = self.spk_embed_affine_layer(F.normalize(spks, dim=1))
+
+        if prompt_feat_len is not None:
+            cond = cond * (~make_pad_mask(prompt_feat_len, cond.size(1))).unsqueeze(-1).to(cond)
+        cond = cond.transpose(1, 2).contiguous()
+        return spks, cond
+
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -202,41 +221,145 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  finalize):
-        if self.fp16 is True:
-            prompt_feat = prompt_feat.half()
-            embedding = embedding.half()
-
-        assert token.shape[0] == 1
-        # xvec projection
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)
+                  finalize,
+                  n_timesteps=10,
+                  solver=None,
+                  cfg_steps=None):
+        # B utterances of different lengths are decoded together: `token` is padded to the longest one, and
+        # the prompt (`prompt_*`, `embedding`) is either per row or a batch of 1 shared by all the rows.
+        B = token.size(0)
+        embedding, prompt_cond = self.prepare_prompt(prompt_feat, prompt_feat_len, embedding)
+        embedding = embedding.expand(B, -1)
+        prompt_cond = prompt_cond.expand(B, -1, -1)
+        prompt_token = prompt_token.expand(B, -1)
+        prompt_token_len = prompt_token_len.to(token_len).expand(B)
+        if prompt_feat_len is None:
+            prompt_feat_len = torch.full((B,), prompt_feat.size(1), device=token.device)
+        prompt_feat_len = prompt_feat_len.to(token_len).expand(B)
 
-        # concat text and prompt_text
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
-        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
+        # concat text and prompt_text; every row is [prompt_token | token | padding]
+        seq = torch.arange(int((prompt_token_len + token_len).max()), device=token.device).expand(B, -1)
+        token_idx = seq - prompt_token_len.unsqueeze(1)
+        token = torch.where(
+            token_idx < 0,
+            prompt_token.gather(1, seq.clamp(max=prompt_token.size(1) - 1)),
+            token.gather(1, token_idx.clamp(min=0, max=token.size(1) - 1)),
+        )
+        token_len = prompt_token_len + token_len
+        mask = (~make_pad_mask(token_len, token.size(1))).unsqueeze(-1).to(embedding)
         token = self.input_embedding(torch.clamp(token, min=0)) * mask
 
         # text encode
-        h, h_lengths = self.encoder(token, token_len)
+        h, h_masks = self.encoder(token, token_len)
+        h_lens = h_masks.squeeze(1).sum(dim=1)
         if finalize is False:
             h = h[:, :-self.pre_lookahead_len * self.token_mel_ratio]
-        mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
+            h_lens = h_lens - self.pre_lookahead_len * self.token_mel_ratio
+        mel_len1, mel_len2 = prompt_feat_len, h_lens - prompt_feat_len
         h = self.encoder_proj(h)
 
-        # get conditions
-        conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
-        conds[:, :mel_len1] = prompt_feat
-        conds = conds.transpose(1, 2)
+        # get conditions: the prompt frames, then zeros
+        conds = F.pad(prompt_cond.to(h.dtype), (0, h.size(1) - prompt_cond.size(2)))
 
-        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
+        mask = (~make_pad_mask(h_lens, h.size(1))).to(h)
         feat, _ = self.decoder(
             mu=h.transpose(1, 2).contiguous(),
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10
+            n_timesteps=n_timesteps,
+            solver=solver,
+            cfg_steps=cfg_steps,
         )
-        feat = feat[:, :, mel_len1:]
-        assert feat.shape[2] == mel_len2
-        return feat.float(), None  # NOTE jrm: why are they returning None here?
+
+        # drop the prompt frames of every row, and left-align what is left
+        feat_idx = mel_len1.unsqueeze(1) + torch.arange(int(mel_len2.max()), device=feat.device)
+        feat = feat.gather(2, feat_idx.clamp(max=feat.size(2) - 1).unsqueeze(1).expand(-1, feat.size(1), -1))
+        feat = feat * (~make_pad_mask(mel_len2, feat.size(2))).unsqueeze(1)
+        return feat.float(), mel_len2
+
+    @torch.inference_mode()
+    def stream_init(self,
+                    prompt_token,
+                    prompt_token_len,
+                    prompt_feat,
+                    prompt_feat_len,
+                    embedding):
+        """
+        Start streaming token-to-mel for one utterance (batch of 1) and its prompt, see `inference_chunk`.
+        Returns the state of the stream.
+        """
+        mel_len1 = prompt_feat.size(1) if prompt_feat_len is None else int(prompt_feat_len[0])
+        embedding, prompt_cond = self.prepare_prompt(prompt_feat, prompt_feat_len, embedding)
+
+        return dict(
+            embedding=embedding,
+            prompt_cond=prompt_cond[:, :, :mel_len1],
+            # tokens that are not encoded yet, which the next chunk looks ahead at: the prompt comes first
+            pending=prompt_token[:, :int(prompt_token_len[0])],
+            encoder_cache=None,
+            # the projected encoder output of all the encoded tokens so far
+            h=None,
+            # the number of frames of `h` that are already returned as mels (or are the prompt)
+            n_frames=mel_len1,
+        )
+
+    @torch.inference_mode()
+    def inference_chunk(self,
+                        token,
+                        state,
+                        finalize=False,
+                        n_timesteps=10,
+                        solver=None,
+                        cfg_steps=None):
+        """
+        Streaming `inference`: the mels of the next tokens (1, T) of the stream started with `stream_init`.
+
+        Only the new tokens go through the encoder (see `UpsampleConformerEncoder.forward_chunk`), so the
+        encoder output of a frame does not change once it is computed. The last `pre_lookahead_len` tokens are
+        held back until the tokens they look ahead at arrive, or until `finalize`. The CFM decoder still runs
+        over all the frames so far, as in `inference`, and only the mels of the new frames are returned, so the
+        decoder cost of a chunk grows with the length of the stream.
+
+        NOTE: the encoder of `inference` attends over all the tokens, while here a frame only sees the tokens
+        up to the end of its chunk (and the lookahead), so the mels differ from those of `inference` for the
+        same tokens, unless the whole stream is a single chunk.
+
+        Returns the new mels (1, 80, T') and the state for the next chunk.
+        """
+        state = dict(state)
+        pending = torch.cat([state["pending"], token.to(state["pending"])], dim=1)
+        n_encode = pending.size(1) if finalize else pending.size(1) - self.pre_lookahead_len
+        if n_encode <= 0:
+            state["pending"] = pending
+            return torch.zeros(1, self.output_size, 0, device=token.device), state
+
+        # text encode, with the held back tokens as the lookahead context
+        token = self.input_embedding(torch.clamp(pending, min=0)).to(state["embedding"])
+        h, state["encoder_cache"] = self.encoder.forward_chunk(
+            token[:, :n_encode],
+            context=None if finalize else token[:, n_encode:],
+            cache=state["encoder_cache"],
+        )
+        state["pending"] = pending[:, n_encode:]
+        h = self.encoder_proj(h)
+        h = h if state["h"] is None else torch.cat([state["h"], h], dim=1)
+        state["h"] = h
+
+        # get conditions: the prompt frames, then zeros
+        prompt_cond = state["prompt_cond"][:, :, :h.size(1)].to(h.dtype)
+        conds = F.pad(prompt_cond, (0, h.size(1) - prompt_cond.size(2)))
+
+        mask = torch.ones(1, 1, h.size(1), device=h.device, dtype=h.dtype)
+        feat, _ = self.decoder(
+            mu=h.transpose(1, 2).contiguous(),
+            mask=mask,
+            spks=state["embedding"],
+            cond=conds,
+            n_timesteps=n_timesteps,
+            solver=solver,
+            cfg_steps=cfg_steps,
+        )
+        feat = feat[:, :, state["n_frames"]:]
+        state["n_frames"] = max(state["n_frames"], h.size(1))
+        return feat.float(), state
@@ -11,13 +11,20 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import logging
+import tempfile
 import threading
+from pathlib import Path
 import torch
 import torch.nn.functional as F
 from .matcha.flow_matching import BASECFM
+from .onnx_estimator import OnnxEstimator, estimator_fingerprint, export_estimator_onnx
 from omegaconf import OmegaConf
 
 
+logger = logging.getLogger(__name__)
+
+
 CFM_PARAMS = OmegaConf.create({
     "sigma_min": 1e-06,
     "solver": "euler",
@@ -27,6 +34,9 @@ CFM_PARAMS = OmegaConf.create({
     "reg_loss_type": "l1"
 })
 
+SOLVERS = ("euler", "midpoint", "heun", "dpm")
+ESTIMATOR_BACKENDS = ("torch", "onnx")
+
 
 class ConditionalCFM(BASECFM):
     def __init__(self, in_channels, cfm_params, n_spks=1, spk_emb_dim=64, estimator: torch.nn.Module = None):
@@ -43,6 +53,44 @@ class ConditionalCFM(BASECFM):
         # Just change the architecture of the estimator here
         self.estimator = estimator
         self.lock = threading.Lock()
+        # runs the estimator in place of the module if set, see `set_estimator_backend`
+        self.estimator_backend = None
+
+    def set_estimator_backend(self, backend: str = "torch", onnx_path=None, num_threads: int = 0):
+        """
+        Select what runs the estimator:
+            * "torch": the `estimator` module
+            * "onnx": onnxruntime on CPU (see `OnnxEstimator`), with the graph cached at `onnx_path`. The
+              estimator is (re-)exported there if the file does not exist yet or was exported from other
+              weights. Without `onnx_path`, or if it cannot be written, the graph is exported to a temporary
+              file that is only kept until the session is loaded.
+        The `estimator` module is kept either way, e.g. for its state dict.
+        """
+        assert backend in ESTIMATOR_BACKENDS, f"unknown estimator backend {backend!r}, expected one of {ESTIMATOR_BACKENDS}"
+        if backend == "torch":
+            self.estimator_backend = None
+            return
+
+        if onnx_path is not None:
+            onnx_path = Path(onnx_path)
+            fingerprint = estimator_fingerprint(self.estimator)
+            if onnx_path.exists():
+                estimator_backend = OnnxEstimator(onnx_path, num_threads=num_threads)
+                if estimator_backend.fingerprint == fingerprint:
+                    self.estimator_backend = estimator_backend
+                    return
+                logger.info(f"{onnx_path} was exported from other weights, exporting it again")
+            try:
+                export_estimator_onnx(self.estimator, onnx_path)
+                self.estimator_backend = OnnxEstimator(onnx_path, num_threads=num_threads)
+                return
+            except OSError as e:
+                logger.warning(f"could not export the estimator to {onnx_path} ({e}), using a temporary file")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            onnx_path = Path(tmp_dir) / "estimator.onnx"
+            export_estimator_onnx(self.estimator, onnx_path)
+            self.estimator_backend = OnnxEstimator(onnx_path, num_threads=num_threads)
 
     @torch.inference_mode()
     def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2)):
@@ -77,9 +125,90 @@ class ConditionalCFM(BASECFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond):
+    def solve(self, x, t_span, mu, mask, spks, cond, solver=None, time_key=None, cfg_steps=None):
+        """
+        Integrate the flow from the noise `x` over `t_span`, with one of `SOLVERS` (by default `cfm_params.solver`):
+            * euler: 1 estimator call per step
+            * midpoint, heun: 2nd order, 2 estimator calls per step
+            * dpm: 2nd order multistep (DPM-Solver++(2M)-style), 1 estimator call per step; the slope of the
+              previous step is reused to correct the current one
+        The 2nd order solvers are meant for few-step decoding, e.g. 4-6 steps instead of 10 euler steps.
+
+        `time_key` identifies a fixed `t_span`, e.g. (n_timesteps, t_scheduler, dtype, device), so that the
+        estimator can serve its time embeddings from a cache (see `ConditionalDecoder.get_time_embedding_lut`).
+
+        `cfg_steps` limits Classifier-Free Guidance to the first `cfg_steps` steps (all of them if None). The
+        other steps only run the conditional rows through the estimator, i.e. half the batch.
+        """
+        solver = solver or self.solver
+        assert solver in SOLVERS, f"unknown solver {solver!r}, expected one of {SOLVERS}"
+        return getattr(self, f"solve_{solver}")(
+            x, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, time_key=time_key, cfg_steps=cfg_steps,
+        )
+
+    def _cfg_inputs(self, x, t_span, mu, mask, spks, cond, time_key=None):
+        """
+        Preallocate the estimator inputs for a solve. Rows [:B] are conditional, rows [B:] are the
+        unconditional CFG rows (zero mu / spks / cond). The inputs that do not change over the solve are
+        only filled once, and the estimator derives its own step-invariant tensors from them once (see
+        `ConditionalDecoder.prepare_solve_context`).
+        """
+        # Do not use concat, it may cause memory format changed and trt infer with wrong results!
+        B = x.size(0)
+        inputs = dict(
+            x=torch.zeros([2 * B, 80, x.size(2)], device=x.device, dtype=x.dtype),
+            mask=torch.zeros([2 * B, 1, x.size(2)], device=x.device, dtype=x.dtype),
+            mu=torch.zeros([2 * B, 80, x.size(2)], device=x.device, dtype=x.dtype),
+            t=torch.zeros([2 * B], device=x.device, dtype=x.dtype),
+            spks=torch.zeros([2 * B, 80], device=x.device, dtype=x.dtype),
+            cond=torch.zeros([2 * B, 80, x.size(2)], device=x.device, dtype=x.dtype),
+        )
+        inputs["mask"][:B] = mask
+        inputs["mask"][B:] = mask
+        inputs["mu"][:B] = mu
+        inputs["spks"][:B] = spks
+        inputs["cond"][:B] = cond
+
+        context, cond_context, t_emb_lut = None, None, None
+        estimator = self.estimator if self.estimator_backend is None else self.estimator_backend
+        if hasattr(estimator, "prepare_solve_context"):
+            context = estimator.prepare_solve_context(inputs["mask"], inputs["mu"], inputs["spks"], inputs["cond"])
+            cond_context = context.narrow(B)
+        if time_key is not None and hasattr(estimator, "get_time_embedding_lut"):
+            t_emb_lut = estimator.get_time_embedding_lut(t_span, time_key)
+        return dict(inputs, context=context, cond_context=cond_context, t_emb_lut=t_emb_lut)
+
+    def _cfg_velocity(self, inputs, x, t, step=None, guide=True):
+        """
+        Estimate the flow at (x, t), with Classifier-Free Guidance (introduced in VoiceBox) if `guide`, else
+        with the conditional rows only. `step` is the index of `t` in `t_span`, if it is on the grid.
+        """
+        B = x.size(0)
+        n_rows = 2 * B if guide else B
+        inputs["x"][:B] = x
+        if guide:
+            inputs["x"][B:] = x
+        inputs["t"][:] = t
+        t_emb = None
+        if step is not None and inputs["t_emb_lut"] is not None:
+            t_emb = inputs["t_emb_lut"][step].expand(n_rows, -1)
+        # (slices of the first rows are still contiguous)
+        dphi_dt = self.forward_estimator(
+            inputs["x"][:n_rows], inputs["mask"][:n_rows],
+            inputs["mu"][:n_rows], inputs["t"][:n_rows],
+            inputs["spks"][:n_rows],
+            inputs["cond"][:n_rows],
+            context=inputs["context"] if guide else inputs["cond_context"],
+            t_emb=t_emb,
+        )
+        if not guide:
+            return dphi_dt.clone()  # the TensorRT / ONNX backends return one of their buffers
+        dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [B, B], dim=0)
+        return (1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt
+
+    def solve_euler(self, x, t_span, mu, mask, spks, cond, time_key=None, cfg_steps=None):
         """
         Fixed euler solver for ODEs.
         Args:
@@ -93,6 +222,8 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            time_key (optional): see `solve`
+            cfg_steps (int, optional): see `solve`
         """
         t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
         t = t.unsqueeze(dim=0)
@@ -101,29 +232,10 @@ class ConditionalCFM(BASECFM):
         # Or in future might add like a return_all_steps flag
         sol = []
 
-        # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        inputs = self._cfg_inputs(x, t_span, mu, mask, spks, cond, time_key)
         for step in range(1, len(t_span)):
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in
-            )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
+            guide = cfg_steps is None or step - 1 < cfg_steps
+            dphi_dt = self._cfg_velocity(inputs, x, t, step - 1, guide)
             x = x + dt * dphi_dt
             t = t + dt
             sol.append(x)
@@ -132,17 +244,62 @@ class ConditionalCFM(BASECFM):
 
         return sol[-1].float()
 
-    def forward_estimator(self, x, mask, mu, t, spks, cond):
-        if isinstance(self.estimator, torch.nn.Module):
-            return self.estimator.forward(x, mask, mu, t, spks, cond)
+    def solve_midpoint(self, x, t_span, mu, mask, spks, cond, time_key=None, cfg_steps=None):
+        "Explicit midpoint solver, see `solve_euler` for the args."
+        inputs = self._cfg_inputs(x, t_span, mu, mask, spks, cond, time_key)
+        for i, (t0, t1) in enumerate(zip(t_span[:-1], t_span[1:])):
+            dt = t1 - t0
+            guide = cfg_steps is None or i < cfg_steps
+            dphi_dt = self._cfg_velocity(inputs, x, t0, i, guide)
+            dphi_dt = self._cfg_velocity(inputs, x + 0.5 * dt * dphi_dt, t0 + 0.5 * dt, guide=guide)
+            x = x + dt * dphi_dt
+        return x.float()
+
+    def solve_heun(self, x, t_span, mu, mask, spks, cond, time_key=None, cfg_steps=None):
+        "Heun's (explicit trapezoidal) solver, see `solve_euler` for the args."
+        inputs = self._cfg_inputs(x, t_span, mu, mask, spks, cond, time_key)
+        for i, (t0, t1) in enumerate(zip(t_span[:-1], t_span[1:])):
+            dt = t1 - t0
+            guide = cfg_steps is None or i < cfg_steps
+            dphi_dt = self._cfg_velocity(inputs, x, t0, i, guide)
+            dphi_dt_next = self._cfg_velocity(inputs, x + dt * dphi_dt, t1, i + 1, guide)
+            x = x + 0.5 * dt * (dphi_dt + dphi_dt_next)
+        return x.float()
+
+    def solve_dpm(self, x, t_span, mu, mask, spks, cond, time_key=None, cfg_steps=None):
+        """
+        2nd order multistep solver, see `solve_euler` for the args. The first step is an euler step, the next
+        ones extrapolate linearly from the slopes of the current and the previous steps (variable step size).
+        """
+        inputs = self._cfg_inputs(x, t_span, mu, mask, spks, cond, time_key)
+        prev_dphi_dt, prev_dt = None, None
+        for i, (t0, t1) in enumerate(zip(t_span[:-1], t_span[1:])):
+            dt = t1 - t0
+            guide = cfg_steps is None or i < cfg_steps
+            dphi_dt = self._cfg_velocity(inputs, x, t0, i, guide)
+            if prev_dphi_dt is None:
+                x = x + dt * dphi_dt
+            else:
+                r = dt / prev_dt
+                x = x + dt * ((1 + 0.5 * r) * dphi_dt - 0.5 * r * prev_dphi_dt)
+            prev_dphi_dt, prev_dt = dphi_dt, dt
+        return x.float()
+
+    def forward_estimator(self, x, mask, mu, t, spks, cond, context=None, t_emb=None):
+        if isinstance(self.estimator_backend, OnnxEstimator):
+            return self.estimator_backend(x, mask, mu, t, spks, cond)
+        elif isinstance(self.estimator, torch.nn.Module):
+            # the step-invariant inputs precomputed by the estimator itself, if any
+            extras = {k: v for k, v in dict(context=context, t_emb=t_emb).items() if v is not None}
+            return self.estimator.forward(x, mask, mu, t, spks, cond, **extras)
         else:
             with self.lock:
-                self.estimator.set_input_shape('x', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('mask', (2, 1, x.size(2)))
-                self.estimator.set_input_shape('mu', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('t', (2,))
-                self.estimator.set_input_shape('spks', (2, 80))
-                self.estimator.set_input_shape('cond', (2, 80, x.size(2)))
+                self.estimator.set_input_shape('x', (x.size(0), 80, x.size(2)))
+                self.estimator.set_input_shape('mask', (x.size(0), 1, x.size(2)))
+                self.estimator.set_input_shape('mu', (x.size(0), 80, x.size(2)))
+                self.estimator.set_input_shape('t', (x.size(0),))
+                self.estimator.set_input_shape('spks', (x.size(0), 80))
+                self.estimator.set_input_shape('cond', (x.size(0), 80, x.size(2)))
                 # run trt engine
                 self.estimator.execute_v2([x.contiguous().data_ptr(),
                                            mask.contiguous().data_ptr(),
@@ -201,7 +358,7 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, solver=None, cfg_steps=None):
         """Forward diffusion
 
         Args:
@@ -214,15 +371,23 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): one of `SOLVERS`. Defaults to `cfm_params.solver`.
+            cfg_steps (int, optional): the number of first steps that use CFG, see `solve`. Defaults to all.
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
+        # every row starts at its prompt, so all rows share the same fixed noise
         z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        z = z.expand(mu.size(0), -1, -1)
         # fix prompt and overlap part mu and z
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
+        time_key = (n_timesteps, self.t_scheduler, mu.dtype, mu.device)
+        return self.solve(
+            z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond,
+            solver=solver, time_key=time_key, cfg_steps=cfg_steps,
+        ), None
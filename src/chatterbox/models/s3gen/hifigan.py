@@ -24,9 +24,8 @@ import torch
 import torch.nn.functional as F
 from torch.nn import Conv1d
 from torch.nn import ConvTranspose1d
-from torch.nn.utils import remove_weight_norm
+from torch.nn.utils import parametrize
 from torch.nn.utils.parametrizations import weight_norm
-from torch.distributions.uniform import Uniform
 from torch import nn, sin, pow
 from torch.nn import Parameter
 
@@ -69,6 +68,19 @@ class Snake(nn.Module):
         self.alpha.requires_grad = alpha_trainable
 
         self.no_div_by_zero = 0.000000001
+        self.fused = False
+
+    def fuse(self):
+        '''
+        Precompute the per-channel terms of the forward pass, a and 1/a, for inference.
+        Call it again if alpha changes (e.g. after loading weights).
+        '''
+        alpha = self.alpha.detach().unsqueeze(0).unsqueeze(-1)
+        if self.alpha_logscale:
+            alpha = torch.exp(alpha)
+        self.register_buffer("alpha_fused", alpha, persistent=False)
+        self.register_buffer("inv_alpha_fused", 1.0 / (alpha + self.no_div_by_zero), persistent=False)
+        self.fused = True
 
     def forward(self, x):
         '''
@@ -76,6 +88,9 @@ class Snake(nn.Module):
         Applies the function to the input elementwise.
         Snake ∶= x + 1/a * sin^2 (xa)
         '''
+        if self.fused:
+            return torch.addcmul(x, self.inv_alpha_fused, pow(sin(x * self.alpha_fused), 2))
+
         alpha = self.alpha.unsqueeze(0).unsqueeze(-1) # line up with x to [B, C, T]
         if self.alpha_logscale:
             alpha = torch.exp(alpha)
@@ -85,6 +100,13 @@ class Snake(nn.Module):
 
 
 
+def remove_weight_norm(module):
+    "Fold the `weight_norm` parametrization of `module` into a plain weight (a no-op if it has none)."
+    if parametrize.is_parametrized(module, "weight"):
+        parametrize.remove_parametrizations(module, "weight")
+    return module
+
+
 def get_padding(kernel_size, dilation=1):
     return int((kernel_size * dilation - dilation) / 2)
 
@@ -192,43 +214,81 @@ class SineGen(torch.nn.Module):
         self.sampling_rate = samp_rate
         self.voiced_threshold = voiced_threshold
 
+        # 1 .. harmonic_num + 1, to build all the harmonics with one broadcasted multiply
+        harmonics = torch.arange(1, harmonic_num + 2, dtype=torch.float32).view(1, -1, 1)
+        self.register_buffer("harmonics", harmonics, persistent=False)
+        # 1 .. upsample_scale, the sample offsets within a frame (reallocated if the scale changes)
+        self.register_buffer("ramp", torch.zeros(0), persistent=False)
+
     def _f02uv(self, f0):
         # generate uv signal
         uv = (f0 > self.voiced_threshold).type(torch.float32)
         return uv
 
+    def initial_phase(self, batch_size, device):
+        """
+        :return: random initial phases of the harmonics in cycles, [B, harmonic_num + 1, 1] (0 for the fundamental)
+        """
+        phase = (torch.rand(batch_size, self.harmonic_num + 1, 1) - 0.5).to(device)
+        phase[:, 0, :] = 0
+        return phase
+
+    def _frame_phases(self, f0, upsample_scale, phase):
+        # the frequencies of the harmonics in cycles per sample, [B, H, T], and their phases at the first sample
+        # of every frame, [B, H, T + 1]. f0 is constant within a frame, so the cumulative sum only runs at frame
+        # resolution, and every frame's increment is wrapped first to keep the float32 precision.
+        freq = f0 * self.harmonics / self.sampling_rate
+        increments = (freq * upsample_scale) % 1
+        start = torch.cat([phase, phase + torch.cumsum(increments, dim=-1)], dim=-1) % 1
+        return freq, start
+
+    def end_phase(self, f0, upsample_scale=1, phase=None):
+        """
+        :param f0: [B, 1, frame_len], Hz, see `forward`
+        :param phase: [B, harmonic_num + 1, 1], the phases at the first sample, see `forward`
+        :return: [B, harmonic_num + 1, 1], the phases after the last sample, to continue the harmonics in the next chunk
+        """
+        if phase is None:
+            phase = torch.zeros(f0.size(0), self.harmonic_num + 1, 1, device=f0.device)
+        _, start = self._frame_phases(f0, upsample_scale, phase)
+        return start[:, :, -1:]
+
     @torch.no_grad()
-    def forward(self, f0):
+    def forward(self, f0, upsample_scale=1, phase=None):
         """
-        :param f0: [B, 1, sample_len], Hz
-        :return: [B, 1, sample_len]
+        :param f0: [B, 1, frame_len], Hz, every frame lasting `upsample_scale` samples (nearest upsampling)
+        :param phase: [B, harmonic_num + 1, 1], the phases of the harmonics at the first sample in cycles, e.g.
+            from `end_phase` of the previous chunk (random by default, see `initial_phase`)
+        :return: [B, harmonic_num + 1, frame_len * upsample_scale]
         """
+        B, _, T = f0.shape
+        if phase is None:
+            phase = self.initial_phase(B, f0.device)
+        freq, start = self._frame_phases(f0, upsample_scale, phase)
 
-        F_mat = torch.zeros((f0.size(0), self.harmonic_num + 1, f0.size(-1))).to(f0.device)
-        for i in range(self.harmonic_num + 1):
-            F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
+        if self.ramp.numel() != upsample_scale or self.ramp.device != f0.device:
+            self.ramp = torch.arange(1, upsample_scale + 1, dtype=torch.float32, device=f0.device)
 
-        theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
-        u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
-        phase_vec[:, 0, :] = 0
+        # the phase after every sample in cycles, [B, H, T, upsample_scale] (frac is the cheaper % 1, as f0 >= 0)
+        theta_mat = torch.addcmul(start[:, :, :-1, None], freq[..., None], self.ramp).frac_()
 
-        # generate sine waveforms
-        sine_waves = self.sine_amp * torch.sin(theta_mat + phase_vec)
+        # generate sine waveforms, in place as these are the large tensors
+        sine_waves = theta_mat.mul_(2 * np.pi).sin_().mul_(self.sine_amp)
 
-        # generate uv signal
-        uv = self._f02uv(f0)
+        # generate uv signal, [B, 1, T, 1]
+        uv = self._f02uv(f0)[..., None]
 
         # noise: for unvoiced should be similar to sine_amp
         #        std = self.sine_amp/3 -> max value ~ self.sine_amp
         # .       for voiced regions is self.noise_std
         noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
-        noise = noise_amp * torch.randn_like(sine_waves)
+        noise = torch.randn_like(sine_waves).mul_(noise_amp)
 
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
-        sine_waves = sine_waves * uv + noise
-        return sine_waves, uv, noise
+        sine_waves = sine_waves.mul_(uv).add_(noise)
+        uv = uv.expand(-1, -1, -1, upsample_scale)
+        return sine_waves.flatten(2), uv.flatten(2), noise.flatten(2)
 
 
 class SourceModuleHnNSF(torch.nn.Module):
@@ -255,6 +315,7 @@ class SourceModuleHnNSF(torch.nn.Module):
 
         self.sine_amp = sine_amp
         self.noise_std = add_noise_std
+        self.upsample_scale = int(upsample_scale)
 
         # to produce sine waveforms
         self.l_sin_gen = SineGen(sampling_rate, harmonic_num,
@@ -264,16 +325,17 @@ class SourceModuleHnNSF(torch.nn.Module):
         self.l_linear = torch.nn.Linear(harmonic_num + 1, 1)
         self.l_tanh = torch.nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, upsample_scale=1, phase=None):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
-        F0_sampled (batchsize, length, 1)
-        Sine_source (batchsize, length, 1)
-        noise_source (batchsize, length 1)
+        F0_sampled (batchsize, length, 1), every value lasting `upsample_scale` samples
+        Sine_source (batchsize, length * upsample_scale, 1)
+        noise_source (batchsize, length * upsample_scale, 1)
+        phase: initial phases of the harmonics, see `SineGen.forward`
         """
         # source for harmonic branch
         with torch.no_grad():
-            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2))
+            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2), upsample_scale=upsample_scale, phase=phase)
             sine_wavs = sine_wavs.transpose(1, 2)
             uv = uv.transpose(1, 2)
         sine_merge = self.l_tanh(self.l_linear(sine_wavs))
@@ -326,7 +388,8 @@ class HiFTGenerator(nn.Module):
             sine_amp=nsf_alpha,
             add_noise_std=nsf_sigma,
             voiced_threshod=nsf_voiced_threshold)
-        self.f0_upsamp = torch.nn.Upsample(scale_factor=np.prod(upsample_rates) * istft_params["hop_len"])
+        self.upsample_scale = int(np.prod(upsample_rates)) * istft_params["hop_len"]
+        self.f0_upsamp = torch.nn.Upsample(scale_factor=self.upsample_scale)
 
         self.conv_pre = weight_norm(
             Conv1d(in_channels, base_channels, 7, 1, padding=3)
@@ -351,7 +414,7 @@ class HiFTGenerator(nn.Module):
         self.source_downs = nn.ModuleList()
         self.source_resblocks = nn.ModuleList()
         downsample_rates = [1] + upsample_rates[::-1][:-1]
-        downsample_cum_rates = np.cumprod(downsample_rates)
+        downsample_cum_rates = [int(u) for u in np.cumprod(downsample_rates)]  # python ints, for torch.compile
         for i, (u, k, d) in enumerate(zip(downsample_cum_rates[::-1], source_resblock_kernel_sizes, source_resblock_dilation_sizes)):
             if u == 1:
                 self.source_downs.append(
@@ -387,11 +450,19 @@ class HiFTGenerator(nn.Module):
             l.remove_weight_norm()
         remove_weight_norm(self.conv_pre)
         remove_weight_norm(self.conv_post)
-        self.m_source.remove_weight_norm()
         for l in self.source_downs:
             remove_weight_norm(l)
         for l in self.source_resblocks:
             l.remove_weight_norm()
+        if self.f0_predictor is not None:
+            for l in self.f0_predictor.modules():
+                remove_weight_norm(l)
+
+    def fuse_activations(self):
+        "Precompute the Snake activation terms for inference, see `Snake.fuse`."
+        for m in self.modules():
+            if isinstance(m, Snake):
+                m.fuse()
 
     def _stft(self, x):
         spec = torch.stft(
@@ -443,6 +514,14 @@ class HiFTGenerator(nn.Module):
         x = torch.clamp(x, -self.audio_limit, self.audio_limit)
         return x
 
+    def source(self, f0: torch.Tensor, phase: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        The source excitation [B, 1, T * upsample_scale] of the frame-level f0 [B, T]. It is synthesized from the
+        frames directly, which is the same as from `f0_upsamp` (nearest) upsampled f0, see `SineGen.forward`.
+        """
+        s, _, _ = self.m_source(f0[:, :, None], upsample_scale=self.upsample_scale, phase=phase)
+        return s.transpose(1, 2)
+
     def forward(
             self,
             batch: dict,
@@ -452,9 +531,7 @@ class HiFTGenerator(nn.Module):
         # mel->f0
         f0 = self.f0_predictor(speech_feat)
         # f0->source
-        s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
-        s, _, _ = self.m_source(s)
-        s = s.transpose(1, 2)
+        s = self.source(f0)
         # mel+source->speech
         generated_speech = self.decode(x=speech_feat, s=s)
         return generated_speech, f0
@@ -464,11 +541,107 @@ class HiFTGenerator(nn.Module):
         # mel->f0
         f0 = self.f0_predictor(speech_feat)
         # f0->source
-        s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
-        s, _, _ = self.m_source(s)
-        s = s.transpose(1, 2)
+        s = self.source(f0)
         # use cache_source to avoid glitch
         if cache_source.shape[2] != 0:
             s[:, :, :cache_source.shape[2]] = cache_source
         generated_speech = self.decode(x=speech_feat, s=s)
         return generated_speech, s
+
+
+def fade_in_out(fade_in_wav, fade_out_wav, window):
+    """
+    Cross-fade the start of `fade_in_wav` with the tail of `fade_out_wav`, both shaped (..., T).
+    `window` is a symmetric window whose first half fades in and whose second half fades out.
+    """
+    overlap = window.size(0) // 2
+    fade_in_wav = fade_in_wav.clone()
+    fade_in_wav[..., :overlap] = fade_in_wav[..., :overlap] * window[:overlap] + \
+        fade_out_wav[..., -overlap:] * window[overlap:]
+    return fade_in_wav
+
+
+class HiFTStreamSession:
+    """
+    Vocodes a mel stream (batch of 1) chunk by chunk with a `HiFTGenerator`, keeping only a bounded state:
+        * the last `mel_cache_len` mel frames, which are vocoded again with the next chunk, so that the
+          convolutions and the iSTFT overlap-add at the chunk boundary see both sides
+        * the `m_source` excitation of those frames, which is reused for them, and the phases of its harmonics
+          at its end, where the excitation of the new frames continues (see `SineGen.end_phase`), so that the
+          harmonic source is continuous across chunks and only synthesized once
+        * the audio of those frames, which is cross-faded with their re-vocoded audio
+    The audio of the cached frames is held back until the next chunk (or `finalize`), so the emitted PCM
+    chunks simply concatenate.
+
+    Usage:
+        session = HiFTStreamSession(hift)
+        for mel in mel_chunks:
+            play(session.push(mel))
+        play(session.flush())
+    """
+
+    def __init__(self, hift: HiFTGenerator, mel_cache_len: int = 8, fade_in: Optional[torch.Tensor] = None):
+        self.hift = hift
+        self.mel_cache_len = mel_cache_len
+        self.source_cache_len = mel_cache_len * hift.upsample_scale
+        self.window = torch.hamming_window(2 * self.source_cache_len, periodic=False)
+        # applied to the start of the stream, e.g. to silence the "spillover" from a reference clip
+        self.fade_in = fade_in
+        self.reset()
+
+    def reset(self):
+        "Forget the stream, e.g. to start a new utterance."
+        self.mel = None  # mel frames that are not vocoded for good yet
+        self.source = None
+        self.phase = None  # the phases of the harmonics at the end of `source`
+        self.speech = None
+        self.started = False
+
+    @torch.inference_mode()
+    def push(self, speech_feat: torch.Tensor, finalize: bool = False) -> torch.Tensor:
+        """
+        Vocode the next mel frames (1, 80, T), and return the audio (1, T') that is final so far. Without
+        `finalize`, the audio of the last `mel_cache_len` frames is held back; nothing is emitted until there
+        are more frames than that. `finalize` emits everything and resets the session.
+        """
+        mel = speech_feat if self.mel is None else torch.cat([self.mel, speech_feat], dim=2)
+        if mel.size(2) == 0 or (not finalize and mel.size(2) <= self.mel_cache_len):
+            # not enough frames to emit anything yet
+            self.mel = mel
+            if finalize:
+                self.reset()
+            return torch.zeros(1, 0, device=speech_feat.device)
+
+        # mel->f0->source, only synthesizing the source of the frames that are not cached
+        f0 = self.hift.f0_predictor(mel)
+        sine_gen = self.hift.m_source.l_sin_gen
+        if self.phase is None:
+            self.phase = sine_gen.initial_phase(1, mel.device)
+        n_cached = 0 if self.source is None else self.mel_cache_len
+        source = self.hift.source(f0[:, n_cached:], phase=self.phase)
+        self.phase = sine_gen.end_phase(f0[:, None, n_cached:], self.hift.upsample_scale, self.phase)
+        if self.source is not None:
+            source = torch.cat([self.source, source], dim=2)
+        wav = self.hift.decode(x=mel, s=source)
+
+        if self.speech is not None:
+            self.window = self.window.to(wav)
+            wav = fade_in_out(wav, self.speech, self.window)
+        if not self.started and self.fade_in is not None:
+            n_fade = min(len(self.fade_in), wav.size(1))
+            wav[:, :n_fade] *= self.fade_in[:n_fade].to(wav)
+        self.started = True
+
+        if finalize:
+            self.reset()
+            return wav
+
+        self.mel = mel[:, :, -self.mel_cache_len:]
+        self.source = source[:, :, -self.source_cache_len:]
+        self.speech = wav[:, -self.source_cache_len:]
+        return wav[:, :-self.source_cache_len]
+
+    def flush(self) -> torch.Tensor:
+        "Emit the audio that is held back, and reset the session."
+        device = self.mel.device if self.mel is not None else "cpu"
+        return self.push(torch.zeros(1, self.hift.conv_pre.in_channels, 0, device=device), finalize=True)
@@ -0,0 +1,156 @@
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+INPUT_NAMES = ["x", "mask", "mu", "t", "spks", "cond"]
+OUTPUT_NAME = "estimator_out"
+OPSET_VERSION = 18
+# model metadata key of the `estimator_fingerprint` of the exported weights
+FINGERPRINT_KEY = "weights_fingerprint"
+
+
+def estimator_fingerprint(estimator: torch.nn.Module) -> str:
+    "Hash of the state dict of `estimator`, to tell whether an exported graph still matches its weights."
+    h = hashlib.blake2b(digest_size=16)
+    for k, v in estimator.state_dict().items():
+        h.update(k.encode())
+        h.update(str(v.dtype).encode())
+        h.update(v.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+def export_estimator_onnx(estimator: torch.nn.Module, fpath: Union[str, Path], opset_version: int = OPSET_VERSION):
+    """
+    Export the `ConditionalDecoder` of the CFM to ONNX, with dynamic batch and time axes, so that a single
+    graph serves any number of CFG rows and any utterance length. The masks and attention biases are part of
+    the graph (the exported forward has no solve context). The `estimator_fingerprint` of the weights is
+    stored in the model metadata.
+    """
+    import onnx
+    param = next(estimator.parameters())
+    B, T = 2, 64
+    dummy_inputs = (
+        torch.randn(B, 80, T),  # x
+        torch.ones(B, 1, T),  # mask
+        torch.randn(B, 80, T),  # mu
+        torch.rand(B),  # t
+        torch.randn(B, 80),  # spks
+        torch.randn(B, 80, T),  # cond
+    )
+    dummy_inputs = tuple(x.to(device=param.device, dtype=param.dtype) for x in dummy_inputs)
+    dynamic_axes = {
+        "x": {0: "batch", 2: "time"},
+        "mask": {0: "batch", 2: "time"},
+        "mu": {0: "batch", 2: "time"},
+        "t": {0: "batch"},
+        "spks": {0: "batch"},
+        "cond": {0: "batch", 2: "time"},
+        OUTPUT_NAME: {0: "batch", 2: "time"},
+    }
+
+    was_training = estimator.training
+    estimator.eval()
+    try:
+        torch.onnx.export(
+            estimator,
+            dummy_inputs,
+            str(fpath),
+            input_names=INPUT_NAMES,
+            output_names=[OUTPUT_NAME],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            dynamo=False,
+        )
+    finally:
+        estimator.train(was_training)
+
+    model = onnx.load(str(fpath))
+    onnx.helper.set_model_props(model, {FINGERPRINT_KEY: estimator_fingerprint(estimator)})
+    onnx.save(model, str(fpath))
+    logger.info(f"exported the CFM estimator to {fpath}")
+
+
+class OnnxEstimator:
+    """
+    Runs an estimator exported with `export_estimator_onnx` on the onnxruntime CPU provider, as a drop-in for
+    the PyTorch `ConditionalDecoder` (see `ConditionalCFM.set_estimator_backend`). The inputs are bound in
+    place through an IO binding, and the output is written into a preallocated buffer, reused by the next call
+    of the same shape; each call returns its own copy of it, so concurrent callers never share a result.
+    """
+
+    def __init__(self, fpath: Union[str, Path], num_threads: int = 0):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("the onnx estimator backend requires `onnxruntime`") from e
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.fpath = Path(fpath)
+        self.session = ort.InferenceSession(str(self.fpath), sess_options=options, providers=["CPUExecutionProvider"])
+        # the `estimator_fingerprint` of the exported weights, None for graphs exported without one
+        self.fingerprint = self.session.get_modelmeta().custom_metadata_map.get(FINGERPRINT_KEY)
+        self.io_binding = self.session.io_binding()
+        self.output = None
+        self.lock = threading.Lock()
+
+    def __call__(self, x, mask, mu, t, spks, cond):
+        inputs = [x, mask, mu, t, spks, cond]
+        assert all(i.device.type == "cpu" and i.dtype == torch.float32 for i in inputs), \
+            "the onnx estimator backend only supports float32 CPU tensors"
+        inputs = [i.contiguous() for i in inputs]
+
+        with self.lock:
+            if self.output is None or self.output.shape != x.shape:
+                self.output = torch.empty_like(x)
+            for name, tensor in zip(INPUT_NAMES, inputs):
+                self._bind(name, tensor, is_output=False)
+            self._bind(OUTPUT_NAME, self.output, is_output=True)
+            self.session.run_with_iobinding(self.io_binding)
+            return self.output.clone()
+
+    def _bind(self, name, tensor, is_output):
+        bind = self.io_binding.bind_output if is_output else self.io_binding.bind_input
+        bind(
+            name=name,
+            device_type="cpu",
+            device_id=0,
+            element_type=np.float32,
+            shape=tuple(tensor.shape),
+            buffer_ptr=tensor.data_ptr(),
+        )
+
+
+@torch.inference_mode()
+def check_onnx_estimator(estimator: torch.nn.Module, onnx_estimator: OnnxEstimator, batch_size=2, seq_len=200, seed=0):
+    """
+    Run the PyTorch and the ONNX estimators on the same random inputs (with a padded row if there are several),
+    and return the largest absolute difference of their outputs.
+    """
+    g = torch.Generator().manual_seed(seed)
+    B, T = batch_size, seq_len
+    mask = torch.ones(B, 1, T)
+    if B > 1:
+        mask[-1, :, T // 2:] = 0
+    inputs = (
+        torch.randn(B, 80, T, generator=g),
+        mask,
+        torch.randn(B, 80, T, generator=g),
+        torch.rand(B, generator=g),
+        torch.randn(B, 80, generator=g),
+        torch.randn(B, 80, T, generator=g),
+    )
+    param = next(estimator.parameters())
+    expected = estimator(*(i.to(device=param.device, dtype=param.dtype) for i in inputs)).float().cpu()
+    actual = onnx_estimator(*inputs)
+    return (actual - expected).abs().max().item()
@@ -17,17 +17,18 @@ import logging
 import numpy as np
 import torch
 import torchaudio as ta
+from torch.nn.utils.rnn import pad_sequence
 from functools import lru_cache
-from typing import Optional
+from typing import List, Optional, Union
 from omegaconf import DictConfig
 
 from ..s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, S3Tokenizer
 from .const import S3GEN_SR
 from .flow import CausalMaskedDiffWithXvec
 from .xvector import CAMPPlus
-from .utils.mel import mel_spectrogram
+from .utils.mel import MelSpectrogram
 from .f0_predictor import ConvRNNF0Predictor
-from .hifigan import HiFTGenerator
+from .hifigan import HiFTGenerator, HiFTStreamSession
 from .transformer.upsample_encoder import UpsampleConformerEncoder
 from .flow_matching import CausalConditionalCFM
 from .decoder import ConditionalDecoder
@@ -38,6 +39,25 @@ def drop_invalid_tokens(x):
     return x[x < SPEECH_VOCAB_SIZE]
 
 
+def collate_ref_dicts(ref_dicts: List[dict]) -> dict:
+    """
+    Collate the ref dicts (see `S3Token2Mel.embed_ref`) of several utterances into one batched ref dict,
+    padding the prompt tokens and the prompt mels, as taken by `CausalMaskedDiffWithXvec.inference`.
+    """
+    prompt_feat_lens = [
+        rd["prompt_feat"].size(1) if rd["prompt_feat_len"] is None else int(rd["prompt_feat_len"])
+        for rd in ref_dicts
+    ]
+    device = ref_dicts[0]["prompt_token"].device
+    return dict(
+        prompt_token=pad_sequence([rd["prompt_token"][0] for rd in ref_dicts], batch_first=True),
+        prompt_token_len=torch.cat([rd["prompt_token_len"].to(device) for rd in ref_dicts]),
+        prompt_feat=pad_sequence([rd["prompt_feat"][0] for rd in ref_dicts], batch_first=True),
+        prompt_feat_len=torch.tensor(prompt_feat_lens, device=device),
+        embedding=torch.cat([rd["embedding"] for rd in ref_dicts]),
+    )
+
+
 # TODO: global resampler cache
 @lru_cache(100)
 def get_resampler(src_sr, dst_sr, device):
@@ -53,7 +73,7 @@ class S3Token2Mel(torch.nn.Module):
     def __init__(self):
         super().__init__()
         self.tokenizer = S3Tokenizer("speech_tokenizer_v2_25hz")
-        self.mel_extractor = mel_spectrogram # TODO: make it a torch module?
+        self.mel_extractor = MelSpectrogram()
         self.speaker_encoder = CAMPPlus()  # use default args
 
         encoder = UpsampleConformerEncoder(
@@ -117,7 +137,13 @@ class S3Token2Mel(torch.nn.Module):
         ref_sr: int,
         device="auto",
         ref_fade_out=True,
+        ref_wav_16=None,
     ):
+        """
+        `ref_wav_16` optionally is the 16kHz version of `ref_wav` from the same decode (e.g. what the caller
+        already resampled for T3), used for the x-vector and the prompt tokens instead of resampling `ref_wav`
+        again. Only the waveform is shared: the 24kHz mels and the tokenizer's 16kHz mels use different STFTs.
+        """
         device = self.device if device == "auto" else device
         if isinstance(ref_wav, np.ndarray):
             ref_wav = torch.from_numpy(ref_wav).float()
@@ -139,7 +165,12 @@ class S3Token2Mel(torch.nn.Module):
         ref_mels_24_len = None
 
         # Resample to 16kHz
-        ref_wav_16 = get_resampler(ref_sr, S3_SR, device)(ref_wav).to(device)
+        if ref_wav_16 is None:
+            ref_wav_16 = get_resampler(ref_sr, S3_SR, device)(ref_wav).to(device)
+        else:
+            if isinstance(ref_wav_16, np.ndarray):
+                ref_wav_16 = torch.from_numpy(ref_wav_16).float()
+            ref_wav_16 = torch.atleast_2d(ref_wav_16).to(device)
 
         # Speaker embedding
         ref_x_vector = self.speaker_encoder.inference(ref_wav_16)
@@ -163,6 +194,19 @@ class S3Token2Mel(torch.nn.Module):
             embedding=ref_x_vector,
         )
 
+    def set_estimator_backend(self, backend: str = "torch", onnx_path=None, num_threads: int = 0):
+        "Select what runs the CFM estimator, see `ConditionalCFM.set_estimator_backend`."
+        self.flow.decoder.set_estimator_backend(backend, onnx_path=onnx_path, num_threads=num_threads)
+
+    def _cast_ref_dict(self, ref_dict: dict):
+        # type/device casting (all values will be numpy if it's from a prod API call)
+        for rk in list(ref_dict):
+            if isinstance(ref_dict[rk], np.ndarray):
+                ref_dict[rk] = torch.from_numpy(ref_dict[rk])
+            if torch.is_tensor(ref_dict[rk]):
+                ref_dict[rk] = ref_dict[rk].to(self.device)
+        return ref_dict
+
     def forward(
         self,
         speech_tokens: torch.LongTensor,
@@ -172,6 +216,10 @@ class S3Token2Mel(torch.nn.Module):
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
         finalize: bool = False,
+        speech_token_lens: Optional[torch.LongTensor] = None,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+        cfg_steps: Optional[int] = None,
     ):
         """
         Generate waveforms from S3 speech tokens and a reference waveform, which the speaker timbre is inferred from.
@@ -180,37 +228,43 @@ class S3Token2Mel(torch.nn.Module):
         - The speaker encoder accepts 16 kHz waveform.
         - S3TokenizerV2 accepts 16 kHz waveform.
         - The mel-spectrogram for the reference assumes 24 kHz input signal.
-        - This function is designed for batch_size=1 only.
+        - A batch of utterances shares the reference, unless a collated `ref_dict` is given (see `collate_ref_dicts`).
 
         Args
         ----
-        - `speech_tokens`: S3 speech tokens [B=1, T]
+        - `speech_tokens`: S3 speech tokens [B, T], padded to the longest utterance
         - `ref_wav`: reference waveform (`torch.Tensor` with shape=[B=1, T])
         - `ref_sr`: reference sample rate
         - `finalize`: whether streaming is finished or not. Note that if False, the last 3 tokens will be ignored.
+        - `speech_token_lens`: the number of tokens of every utterance [B], by default all of `T`
+        - `n_timesteps`: the number of steps of the flow-matching ODE solver
+        - `solver`: the ODE solver, one of `flow_matching.SOLVERS` (by default the configured "euler")
+        - `cfg_steps`: only the first `cfg_steps` solver steps use Classifier-Free Guidance (by default all of
+          them); the others run the estimator at half the batch, trading some quality for CPU time
+
+        Returns the mels [B, 80, T'], padded to the longest utterance (see `S3Token2Wav.inference_batch`).
         """
         assert (ref_wav is None) ^ (ref_dict is None), f"Must provide exactly one of ref_wav or ref_dict (got {ref_wav} and {ref_dict})"
 
         if ref_dict is None:
             ref_dict = self.embed_ref(ref_wav, ref_sr)
         else:
-            # type/device casting (all values will be numpy if it's from a prod API call)
-            for rk in list(ref_dict):
-                if isinstance(ref_dict[rk], np.ndarray):
-                    ref_dict[rk] = torch.from_numpy(ref_dict[rk])
-                if torch.is_tensor(ref_dict[rk]):
-                    ref_dict[rk] = ref_dict[rk].to(self.device)
+            ref_dict = self._cast_ref_dict(ref_dict)
 
         if len(speech_tokens.shape) == 1:
             speech_tokens = speech_tokens.unsqueeze(0)
 
-        # assert speech_tokens.shape[0] == 1, "only batch size of one allowed for now"
-        speech_token_lens = torch.LongTensor([speech_tokens.size(1)]).to(self.device)
+        if speech_token_lens is None:
+            speech_token_lens = torch.LongTensor([speech_tokens.size(1)] * speech_tokens.size(0))
+        speech_token_lens = speech_token_lens.to(self.device)
 
         output_mels, _ = self.flow.inference(
             token=speech_tokens,
             token_len=speech_token_lens,
             finalize=finalize,
+            n_timesteps=n_timesteps,
+            solver=solver,
+            cfg_steps=cfg_steps,
             **ref_dict,
         )
         return output_mels
@@ -242,6 +296,37 @@ class S3Token2Wav(S3Token2Mel):
         trim_fade[n_trim:] = (torch.cos(torch.linspace(torch.pi, 0, n_trim)) + 1) / 2
         self.register_buffer("trim_fade", trim_fade, persistent=False) # (buffers get automatic device casting)
 
+        # streaming: the last mel frames of a chunk are re-vocoded with the next one (see `HiFTStreamSession`)
+        self.mel_cache_len = 8
+
+        self.weight_norm_folded = False
+
+    def fold_weight_norm(self):
+        """
+        Fold the weight norm of the vocoder convs into plain weights, so that they are not recomputed on every
+        forward. The state dict then has plain `weight`s instead of the weight-norm parametrizations.
+        """
+        if not self.weight_norm_folded:
+            self.mel2wav.remove_weight_norm()
+            self.weight_norm_folded = True
+        return self
+
+    def prepare_for_inference(self, compile: bool = False):
+        """
+        Optimize the vocoder for inference, once the weights are loaded (it cannot be trained afterwards):
+        - fold weight norm into the conv weights, see `fold_weight_norm`
+        - precompute the Snake activation terms, see `Snake.fuse`
+        - with `compile`, `torch.compile` the HiFT decoder and the f0 predictor (set TORCHINDUCTOR_CACHE_DIR
+          to keep the compiled kernels on disk across processes)
+        """
+        self.fold_weight_norm()
+        self.mel2wav.fuse_activations()
+        if compile:
+            self.mel2wav.decode = torch.compile(self.mel2wav.decode, dynamic=True)
+            f0_predictor = self.mel2wav.f0_predictor
+            f0_predictor.forward = torch.compile(f0_predictor.forward, dynamic=True)
+        return self
+
     def forward(
         self,
         speech_tokens,
@@ -250,11 +335,18 @@ class S3Token2Wav(S3Token2Mel):
         ref_sr: Optional[int],
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
-        finalize: bool = False
+        finalize: bool = False,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+        cfg_steps: Optional[int] = None,
     ):
-        output_mels = super().forward(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        output_mels = super().forward(
+            speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize,
+            n_timesteps=n_timesteps, solver=solver, cfg_steps=cfg_steps,
+        )
 
-        # TODO jrm: ignoring the speed control (mel interpolation) and the HiFTGAN caching mechanisms for now.
+        # TODO jrm: ignoring the speed control (mel interpolation) for now.
+        # NOTE: long outputs can be vocoded chunk by chunk with `hift_stream_session`.
         hift_cache_source = torch.zeros(1, 1, 0).to(self.device)
 
         output_wavs, *_ = self.mel2wav.inference(speech_feat=output_mels, cache_source=hift_cache_source)
@@ -275,8 +367,100 @@ class S3Token2Wav(S3Token2Mel):
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
         finalize: bool = False,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+        cfg_steps: Optional[int] = None,
+    ):
+        return super().forward(
+            speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize,
+            n_timesteps=n_timesteps, solver=solver, cfg_steps=cfg_steps,
+        )
+
+    @torch.inference_mode()
+    def flow_stream_init(
+        self,
+        ref_wav: Optional[torch.Tensor] = None,
+        ref_sr: Optional[int] = None,
+        ref_dict: Optional[dict] = None,
+    ) -> dict:
+        "Start a token-to-mel stream for `flow_stream_inference`, see `CausalMaskedDiffWithXvec.stream_init`."
+        assert (ref_wav is None) ^ (ref_dict is None), f"Must provide exactly one of ref_wav or ref_dict (got {ref_wav} and {ref_dict})"
+        if ref_dict is None:
+            ref_dict = self.embed_ref(ref_wav, ref_sr)
+        else:
+            self._cast_ref_dict(ref_dict)
+        return self.flow.stream_init(**ref_dict)
+
+    @torch.inference_mode()
+    def flow_stream_inference(
+        self,
+        speech_tokens,
+        flow_state: dict,
+        finalize: bool = False,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+        cfg_steps: Optional[int] = None,
     ):
-        return super().forward(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        """
+        The mels of the next speech tokens of a stream started with `flow_stream_init`, and the next state of
+        the stream. Only the new tokens go through the encoder, see `CausalMaskedDiffWithXvec.inference_chunk`.
+        """
+        if len(speech_tokens.shape) == 1:
+            speech_tokens = speech_tokens.unsqueeze(0)
+        return self.flow.inference_chunk(
+            speech_tokens.to(self.device), flow_state, finalize=finalize,
+            n_timesteps=n_timesteps, solver=solver, cfg_steps=cfg_steps,
+        )
+
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        speech_tokens: List[torch.LongTensor],
+        ref_dicts: Union[dict, List[dict]],
+        finalize: bool = True,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+        cfg_steps: Optional[int] = None,
+    ) -> List[torch.Tensor]:
+        """
+        Generate the waveforms of several utterances with a single flow-matching solve over all of them.
+
+        Args
+        ----
+        - `speech_tokens`: the 1D speech tokens of every utterance, of any lengths
+        - `ref_dicts`: one ref dict (see `embed_ref`) shared by all the utterances, or one per utterance
+        - `finalize`: whether streaming is finished or not. Note that if False, the last 3 tokens will be ignored.
+        - `n_timesteps`, `solver`, `cfg_steps`: the flow-matching ODE solver, see `S3Token2Mel.forward`
+
+        Returns the waveform [1, L] of every utterance. The vocoder runs per utterance, on its own mel length.
+        """
+        if isinstance(ref_dicts, dict):
+            ref_dict = self._cast_ref_dict(ref_dicts)
+        else:
+            assert len(ref_dicts) == len(speech_tokens), "need one ref dict per utterance"
+            ref_dict = collate_ref_dicts([self._cast_ref_dict(rd) for rd in ref_dicts])
+
+        speech_token_lens = torch.LongTensor([len(t) for t in speech_tokens]).to(self.device)
+        speech_tokens = pad_sequence([t.to(self.device) for t in speech_tokens], batch_first=True)
+
+        output_mels, output_mel_lens = self.flow.inference(
+            token=speech_tokens,
+            token_len=speech_token_lens,
+            finalize=finalize,
+            n_timesteps=n_timesteps,
+            solver=solver,
+            cfg_steps=cfg_steps,
+            **ref_dict,
+        )
+
+        output_wavs = []
+        for mel, mel_len in zip(output_mels, output_mel_lens.tolist()):
+            wav, _ = self.hift_inference(mel[None, :, :mel_len])
+            # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+            n_fade = min(len(self.trim_fade), wav.size(1))
+            wav[:, :n_fade] *= self.trim_fade[:n_fade]
+            output_wavs.append(wav)
+        return output_wavs
 
     @torch.inference_mode()
     def hift_inference(self, speech_feat, cache_source: torch.Tensor = None):
@@ -284,6 +468,28 @@ class S3Token2Wav(S3Token2Mel):
             cache_source = torch.zeros(1, 1, 0).to(self.device)
         return self.mel2wav.inference(speech_feat=speech_feat, cache_source=cache_source)
 
+    @torch.inference_mode()
+    def hift_stream_session(self) -> HiFTStreamSession:
+        "A new session for vocoding a mel stream chunk by chunk, see `HiFTStreamSession`."
+        return HiFTStreamSession(self.mel2wav, mel_cache_len=self.mel_cache_len, fade_in=self.trim_fade)
+
+    def hift_stream_inference(self, speech_feat, hift_cache: Optional[HiFTStreamSession] = None, finalize: bool = False):
+        """
+        Vocode one chunk of a mel stream.
+
+        Args
+        ----
+        - `speech_feat`: new mel frames (B=1, 80, T)
+        - `hift_cache`: the session returned for the previous chunk, or None for the first chunk
+        - `finalize`: whether this is the last chunk, in which case nothing is held back
+
+        Returns the waveform of this chunk and the session for the next one (None if `finalize`).
+        """
+        if hift_cache is None:
+            hift_cache = self.hift_stream_session()
+        wav = hift_cache.push(speech_feat, finalize=finalize)
+        return wav, None if finalize else hift_cache
+
     @torch.inference_mode()
     def inference(
         self,
@@ -295,8 +501,14 @@ class S3Token2Wav(S3Token2Mel):
         ref_dict: Optional[dict] = None,
         cache_source: torch.Tensor = None, # NOTE: this arg is for streaming, it can probably be removed here
         finalize: bool = True,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+        cfg_steps: Optional[int] = None,
     ):
-        output_mels = self.flow_inference(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        output_mels = self.flow_inference(
+            speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize,
+            n_timesteps=n_timesteps, solver=solver, cfg_steps=cfg_steps,
+        )
         output_wavs, output_sources = self.hift_inference(output_mels, cache_source)
 
         # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
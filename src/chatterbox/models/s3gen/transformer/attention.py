@@ -226,11 +226,12 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         """Compute relative positional encoding.
 
         Args:
-            x (torch.Tensor): Input tensor (batch, head, time1, 2*time1-1).
-            time1 means the length of query vector.
+            x (torch.Tensor): Input tensor (batch, head, time1, time1+time2-1).
+            time1 means the length of query vector, and time2 the length of
+            key vector (time2 > time1 when attending to a cache).
 
         Returns:
-            torch.Tensor: Output tensor.
+            torch.Tensor: Output tensor (batch, head, time1, time2).
 
         """
         zero_pad = torch.zeros((x.size()[0], x.size()[1], x.size()[2], 1),
@@ -242,7 +243,7 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
                                  x.size()[1],
                                  x.size(3) + 1, x.size(2))
         x = x_padded[:, :, 1:].view_as(x)[
-            :, :, :, : x.size(-1) // 2 + 1
+            :, :, :, : x.size(-1) - x.size(2) + 1
         ]  # only keep the positions from 0 to time2
         return x
 
@@ -281,14 +281,19 @@ class EspnetRelPositionalEncoding(torch.nn.Module):
         be applied several times.
 
         Args:
-            offset (int or torch.tensor): start offset
+            offset (int or torch.tensor): start offset, i.e. the number of
+                cached key frames before the `size` query frames
             size (int): required size of position encoding
 
         Returns:
-            torch.Tensor: Corresponding encoding
+            torch.Tensor: Corresponding encoding, of the relative positions
+                from (offset + size - 1) to -(size - 1),
+                i.e. (1, offset + 2 * size - 1, d_model)
         """
+        start = self.pe.size(1) // 2 - size - offset + 1
+        assert start >= 0, "positional encoding too short for the cache"
         pos_emb = self.pe[
             :,
-            self.pe.size(1) // 2 - size + 1: self.pe.size(1) // 2 + size,
+            start: self.pe.size(1) // 2 + size,
         ]
         return pos_emb
@@ -15,7 +15,7 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from typing import Optional, Tuple
 
 import torch
 from torch import nn
@@ -62,6 +62,19 @@ class Upsample1D(nn.Module):
         outputs = self.conv(outputs)
         return outputs, input_lengths * self.stride
 
+    def forward_chunk(self, inputs: torch.Tensor, cache: Optional[torch.Tensor] = None):
+        """
+        Streaming `forward`: `cache` holds the last upsampled frames of the previous chunk, which the conv sees
+        in place of the left padding (None for the first chunk). Returns the outputs and the next cache.
+        """
+        outputs = F.interpolate(inputs, scale_factor=float(self.stride), mode="nearest")
+        if cache is None:
+            cache = outputs.new_zeros(outputs.size(0), outputs.size(1), self.stride * 2)
+        outputs = torch.cat([cache, outputs], dim=2)
+        new_cache = outputs[:, :, -self.stride * 2:]
+        outputs = self.conv(outputs)
+        return outputs, new_cache
+
 
 class PreLookaheadLayer(nn.Module):
     def __init__(self, channels: int, pre_lookahead_len: int = 1):
@@ -95,6 +108,37 @@ class PreLookaheadLayer(nn.Module):
         outputs = outputs + inputs
         return outputs
 
+    def forward_chunk(
+        self,
+        inputs: torch.Tensor,
+        context: Optional[torch.Tensor] = None,
+        cache: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Streaming `forward`.
+        inputs: (batch_size, seq_len, channels), the frames of this chunk
+        context: (batch_size, <= pre_lookahead_len, channels), the next frames, which are only looked ahead at;
+            None (or shorter) at the end of the stream, where the lookahead sees zeros as in `forward`
+        cache: the last 2 outputs of `conv1` for the previous chunk, None for the first chunk
+        """
+        outputs = inputs.transpose(1, 2).contiguous()
+        # look ahead
+        if context is not None:
+            outputs = torch.cat([outputs, context[:, :self.pre_lookahead_len].transpose(1, 2)], dim=2)
+        outputs = F.pad(outputs, (0, inputs.size(1) + self.pre_lookahead_len - outputs.size(2)), mode='constant', value=0.0)
+        outputs = F.leaky_relu(self.conv1(outputs))
+        # outputs
+        if cache is None:
+            cache = outputs.new_zeros(outputs.size(0), outputs.size(1), 2)
+        outputs = torch.cat([cache, outputs], dim=2)
+        new_cache = outputs[:, :, -2:]
+        outputs = self.conv2(outputs)
+        outputs = outputs.transpose(1, 2).contiguous()
+
+        # residual connection
+        outputs = outputs + inputs
+        return outputs, new_cache
+
 
 class UpsampleConformerEncoder(torch.nn.Module):
 
@@ -277,6 +321,9 @@ class UpsampleConformerEncoder(torch.nn.Module):
                                               self.static_chunk_size,
                                               num_decoding_left_chunks)
         # lookahead + conformer encoder
+        # NOTE: zero the padding first, so that the lookahead of a padded row sees the same zeros as an
+        # unpadded one (the embedding output is not zero at padded positions)
+        xs = xs.masked_fill(~mask_pad.transpose(1, 2), 0.0)
         xs = self.pre_lookahead_layer(xs)
         xs = self.forward_layers(xs, chunk_masks, pos_emb, mask_pad)
 
@@ -303,6 +350,82 @@ class UpsampleConformerEncoder(torch.nn.Module):
         # for cross attention with decoder later
         return xs, masks
 
+    def forward_chunk(
+        self,
+        xs: torch.Tensor,
+        context: Optional[torch.Tensor] = None,
+        cache: Optional[dict] = None,
+    ) -> Tuple[torch.Tensor, dict]:
+        """Encode the next chunk of a stream, given the cache of the previous chunks.
+
+        The self-attention of every layer spans the cached frames and the chunk, i.e. this is the same as
+        `forward` over the whole stream with a chunk mask where every frame sees its own chunk and all the
+        previous ones. Only the new frames are computed.
+
+        NOTE: with `static_chunk_size=0` (as in S3Gen), `forward` attends to the whole sequence, where a frame
+        also sees all the following frames, so unless the stream is a single chunk the streamed frames differ
+        from the offline `forward` output (by ~0.037 on random inputs).
+
+        Args:
+            xs: the input frames of this chunk (B, T, D), without padding
+            context: the next input frames (B, <= pre_lookahead_len, D), which the lookahead layer sees but
+                are not encoded yet. None at the end of the stream.
+            cache: the cache returned for the previous chunk, None for the first chunk
+        Returns:
+            the encoded frames of this chunk (B, T * up_layer.stride, D), and the cache for the next chunk:
+            the number of frames encoded before and after the upsampling, the lookahead conv state, the
+            upsampling conv state, and the key/value cache of every layer.
+        """
+        if cache is None:
+            no_cache = torch.zeros((0, 0, 0, 0), device=xs.device)
+            cache = dict(
+                offset=0,
+                up_offset=0,
+                lookahead=None,
+                up=None,
+                att_caches=[no_cache] * len(self.encoders),
+                up_att_caches=[no_cache] * len(self.up_encoders),
+            )
+        no_mask = torch.ones((0, 0, 0), dtype=torch.bool, device=xs.device)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+            context = None if context is None else self.global_cmvn(context)
+
+        # lookahead + conformer encoder
+        masks = torch.ones(xs.size(0), 1, xs.size(1), dtype=torch.bool, device=xs.device)
+        xs, pos_emb, _ = self.embed(xs, masks, cache["offset"])
+        if context is not None and context.size(1) > 0:
+            context, _, _ = self.embed(context, masks[:, :, :context.size(1)])
+        xs, lookahead_cache = self.pre_lookahead_layer.forward_chunk(xs, context, cache["lookahead"])
+        att_caches = []
+        for layer, att_cache in zip(self.encoders, cache["att_caches"]):
+            xs, _, att_cache, _ = layer(xs, no_mask, pos_emb, att_cache=att_cache)
+            att_caches.append(att_cache)
+
+        # upsample + conformer encoder
+        xs = xs.transpose(1, 2).contiguous()
+        xs, up_cache = self.up_layer.forward_chunk(xs, cache["up"])
+        xs = xs.transpose(1, 2).contiguous()
+        masks = torch.ones(xs.size(0), 1, xs.size(1), dtype=torch.bool, device=xs.device)
+        xs, pos_emb, _ = self.up_embed(xs, masks, cache["up_offset"])
+        up_att_caches = []
+        for layer, att_cache in zip(self.up_encoders, cache["up_att_caches"]):
+            xs, _, att_cache, _ = layer(xs, no_mask, pos_emb, att_cache=att_cache)
+            up_att_caches.append(att_cache)
+
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+
+        new_cache = dict(
+            offset=cache["offset"] + masks.size(2) // self.up_layer.stride,
+            up_offset=cache["up_offset"] + masks.size(2),
+            lookahead=lookahead_cache,
+            up=up_cache,
+            att_caches=att_caches,
+            up_att_caches=up_att_caches,
+        )
+        return xs, new_cache
+
     def forward_layers(self, xs: torch.Tensor, chunk_masks: torch.Tensor,
                        pos_emb: torch.Tensor,
                        mask_pad: torch.Tensor) -> torch.Tensor:
@@ -1,12 +1,13 @@
 """mel-spectrogram extraction in Matcha-TTS"""
+import logging
+from functools import lru_cache
+
 from librosa.filters import mel as librosa_mel_fn
 import torch
 import numpy as np
 
 
-# NOTE: they decalred these global vars
-mel_basis = {}
-hann_window = {}
+logger = logging.getLogger(__name__)
 
 
 def dynamic_range_compression_torch(x, C=1, clip_val=1e-5):
@@ -30,52 +31,105 @@ feat_extractor: !name:matcha.utils.audio.mel_spectrogram
 
 """
 
-def mel_spectrogram(y, n_fft=1920, num_mels=80, sampling_rate=24000, hop_size=480, win_size=1920,
-                    fmin=0, fmax=8000, center=False):
-    """Copied from https://github.com/shivammehta25/Matcha-TTS/blob/main/matcha/utils/audio.py
-    Set default values according to Cosyvoice's config.
+class MelSpectrogram(torch.nn.Module):
     """
+    `mel_spectrogram` as a module: the mel basis and the window are (non-persistent) buffers, so they follow
+    the module across devices instead of living in global dicts keyed by device.
 
-    if isinstance(y, np.ndarray):
-        y = torch.tensor(y).float()
-
-    if len(y.shape) == 1:
-        y = y[None, ]
-
-    if torch.min(y) < -1.0:
-        print("min value is ", torch.min(y))
-    if torch.max(y) > 1.0:
-        print("max value is ", torch.max(y))
+    The input range check costs a reduction and a host sync per call, so it is off unless `check_range`.
+    """
+    def __init__(self, n_fft=1920, num_mels=80, sampling_rate=24000, hop_size=480, win_size=1920,
+                 fmin=0, fmax=8000, center=False, check_range=False):
+        super().__init__()
+        self.n_fft = n_fft
+        self.num_mels = num_mels
+        self.sampling_rate = sampling_rate
+        self.hop_size = hop_size
+        self.win_size = win_size
+        self.center = center
+        self.check_range = check_range
+        self.pad = int((n_fft - hop_size) / 2)
 
-    global mel_basis, hann_window  # pylint: disable=global-statement,global-variable-not-assigned
-    if f"{str(fmax)}_{str(y.device)}" not in mel_basis:
         mel = librosa_mel_fn(sr=sampling_rate, n_fft=n_fft, n_mels=num_mels, fmin=fmin, fmax=fmax)
-        mel_basis[str(fmax) + "_" + str(y.device)] = torch.from_numpy(mel).float().to(y.device)
-        hann_window[str(y.device)] = torch.hann_window(win_size).to(y.device)
-
-    y = torch.nn.functional.pad(
-        y.unsqueeze(1), (int((n_fft - hop_size) / 2), int((n_fft - hop_size) / 2)), mode="reflect"
-    )
-    y = y.squeeze(1)
-
-    spec = torch.view_as_real(
-        torch.stft(
-            y,
-            n_fft,
-            hop_length=hop_size,
-            win_length=win_size,
-            window=hann_window[str(y.device)],
-            center=center,
-            pad_mode="reflect",
-            normalized=False,
-            onesided=True,
-            return_complex=True,
+        self.register_buffer("mel_basis", torch.from_numpy(mel).float(), persistent=False)
+        self.register_buffer("window", torch.hann_window(win_size), persistent=False)
+
+    def _check_range(self, y):
+        y_min, y_max = torch.stack(torch.aminmax(y)).tolist()
+        if y_min < -1.0:
+            logger.warning(f"min value is {y_min}")
+        if y_max > 1.0:
+            logger.warning(f"max value is {y_max}")
+
+    def _mel(self, y):
+        spec = torch.view_as_real(
+            torch.stft(
+                y,
+                self.n_fft,
+                hop_length=self.hop_size,
+                win_length=self.win_size,
+                window=self.window,
+                center=self.center,
+                pad_mode="reflect",
+                normalized=False,
+                onesided=True,
+                return_complex=True,
+            )
         )
-    )
 
-    spec = torch.sqrt(spec.pow(2).sum(-1) + (1e-9))
+        spec = torch.sqrt(spec.pow(2).sum(-1) + (1e-9))
+
+        spec = torch.matmul(self.mel_basis, spec)
+        spec = spectral_normalize_torch(spec)
+        return spec
+
+    def forward(self, y, y_lens=None):
+        """
+        y: waveform (T) or (B, T)
+        y_lens: lengths of the rows of a padded batch (B). If given, every row is reflect-padded at its own end,
+            as if it was alone, and this returns the mels (B, num_mels, T') zeroed past each row's frames, with
+            the number of frames of every row (B); otherwise only the mels.
+        """
+        if isinstance(y, np.ndarray):
+            y = torch.tensor(y).float()
+        y = y.to(self.window.device)
+
+        if len(y.shape) == 1:
+            y = y[None, ]
 
-    spec = torch.matmul(mel_basis[str(fmax) + "_" + str(y.device)], spec)
-    spec = spectral_normalize_torch(spec)
+        if self.check_range:
+            self._check_range(y)
 
-    return spec
+        if y_lens is None:
+            y = torch.nn.functional.pad(y.unsqueeze(1), (self.pad, self.pad), mode="reflect")
+            return self._mel(y.squeeze(1))
+
+        assert not self.center, "batched mels need center=False"
+        y_lens = torch.as_tensor(y_lens, device=y.device)
+        pos = torch.arange(-self.pad, y.size(1) + self.pad, device=y.device).unsqueeze(0)
+        last = (y_lens - 1).unsqueeze(1)
+        idx = torch.where(pos < 0, -pos, torch.where(pos > last, 2 * last - pos, pos))
+        y = y.gather(1, idx.clamp(min=0, max=y.size(1) - 1))
+
+        mel = self._mel(y)
+        mel_lens = (y_lens + 2 * self.pad - self.n_fft).div(self.hop_size, rounding_mode="floor") + 1
+        mel = mel[..., :int(mel_lens.max())]
+        mask = torch.arange(mel.size(-1), device=mel.device) < mel_lens.unsqueeze(1)
+        return mel * mask.unsqueeze(1), mel_lens
+
+
+@lru_cache(16)
+def _get_mel_spectrogram(n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center, device):
+    return MelSpectrogram(n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center,
+                          check_range=True).to(device)
+
+
+def mel_spectrogram(y, n_fft=1920, num_mels=80, sampling_rate=24000, hop_size=480, win_size=1920,
+                    fmin=0, fmax=8000, center=False):
+    """Copied from https://github.com/shivammehta25/Matcha-TTS/blob/main/matcha/utils/audio.py
+    Set default values according to Cosyvoice's config.
+    """
+    if isinstance(y, np.ndarray):
+        y = torch.tensor(y).float()
+    extractor = _get_mel_spectrogram(n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center, y.device)
+    return extractor(y)
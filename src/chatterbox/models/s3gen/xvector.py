@@ -42,20 +42,68 @@ def pad_list(xs, pad_value):
     return pad
 
 
-def extract_feature(audio):
-    features = []
-    feature_times = []
-    feature_lengths = []
-    for au in audio:
-        feature = Kaldi.fbank(au.unsqueeze(0), num_mel_bins=80)
-        feature = feature - feature.mean(dim=0, keepdim=True)
-        features.append(feature)
-        feature_times.append(au.shape[0])
-        feature_lengths.append(feature.shape[0])
-    # padding for batch inference
-    features_padded = pad_list(features, pad_value=0)
-    # features = torch.cat(features)
-    return features_padded, feature_lengths, feature_times
+def kaldi_fbank(wavs, wav_lens, num_mel_bins=80, sample_rate=16000, frame_length=25, frame_shift=10):
+    """Batched `Kaldi.fbank` (with its default options) of padded waveforms.
+
+    Args:
+        wavs (Tensor): Padded waveforms (B, T).
+        wav_lens (Tensor): Number of valid samples of each waveform (B,).
+
+    Returns:
+        Tensor: Log mel filterbanks (B, M, num_mel_bins), zero past the frames of each row.
+        Tensor: Number of frames of each row (B,).
+    """
+    device, dtype = wavs.device, wavs.dtype
+    window_size = int(sample_rate * frame_length * 0.001)
+    window_shift = int(sample_rate * frame_shift * 0.001)
+    padded_window_size = 1 << (window_size - 1).bit_length()
+
+    # snip_edges: only whole frames
+    feat_lens = ((wav_lens - window_size).div(window_shift, rounding_mode="floor") + 1).clamp(min=0)
+    if wavs.shape[1] < window_size:
+        return wavs.new_zeros(wavs.shape[0], 0, num_mel_bins), feat_lens
+    frames = wavs.unfold(1, window_size, window_shift)  # (B, M, window_size)
+
+    frames = frames - frames.mean(dim=-1, keepdim=True)  # remove dc offset
+    # preemphasis, windowed and zero padded to the fft size in a single buffer
+    windowed = frames.new_zeros(*frames.shape[:2], padded_window_size)
+    torch.sub(frames[..., 1:], frames[..., :-1], alpha=0.97, out=windowed[..., 1:window_size])
+    torch.mul(frames[..., 0], 1 - 0.97, out=windowed[..., 0])
+    window = torch.hann_window(window_size, periodic=False, device=device, dtype=dtype).pow(0.85)  # povey
+    windowed[..., :window_size].mul_(window)
+
+    spectrum = torch.view_as_real(torch.fft.rfft(windowed))
+    spectrum = torch.addcmul(spectrum[..., 0].square(), spectrum[..., 1], spectrum[..., 1])  # power
+    mel_banks, _ = Kaldi.get_mel_banks(num_mel_bins, padded_window_size, float(sample_rate), 20.0, 0.0, 100.0, -500.0, 1.0)
+    mel_banks = F.pad(mel_banks.to(device=device, dtype=dtype), (0, 1))
+    feats = torch.matmul(spectrum, mel_banks.T)
+    feats = feats.clamp(min=torch.finfo(dtype).eps).log()
+
+    frame_mask = torch.arange(feats.shape[1], device=device) < feat_lens.unsqueeze(1)
+    return feats * frame_mask.unsqueeze(-1), feat_lens
+
+
+def extract_feature(audio, audio_lens=None):
+    """Mean normalized fbank features of a list of 1D waveforms, or of padded waveforms (B, T) with their
+    lengths `audio_lens` (all full length if not given)."""
+    if isinstance(audio, (list, tuple)):
+        audio_lens = torch.tensor([au.shape[0] for au in audio], device=audio[0].device)
+        audio = pad_list(audio, pad_value=0)
+    elif audio_lens is None:
+        audio_lens = torch.full((audio.shape[0],), audio.shape[1], device=audio.device)
+    audio_lens = torch.as_tensor(audio_lens, device=audio.device)
+
+    features, feature_lengths = kaldi_fbank(audio, audio_lens, num_mel_bins=80)
+    frame_mask = torch.arange(features.shape[1], device=features.device) < feature_lengths.unsqueeze(1)
+    frame_mask = frame_mask.unsqueeze(-1).to(features.dtype)
+    mean = features.sum(dim=1, keepdim=True) / feature_lengths.view(-1, 1, 1)
+    features = (features - mean) * frame_mask
+    return features, feature_lengths.tolist(), audio_lens.tolist()
+
+
+def mask_padding(x, mask):
+    "Zero the padded frames of `x` (..., T), so that the convolutions see the zero padding of each row's end."
+    return x if mask is None else x * mask
 
 
 class BasicResBlock(torch.nn.Module):
@@ -83,9 +131,10 @@ class BasicResBlock(torch.nn.Module):
                 torch.nn.BatchNorm2d(self.expansion * planes),
             )
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
+        x = mask_padding(x, mask)
         out = F.relu(self.bn1(self.conv1(x)))
-        out = self.bn2(self.conv2(out))
+        out = self.bn2(self.conv2(mask_padding(out, mask)))
         out += self.shortcut(x)
         out = F.relu(out)
         return out
@@ -115,12 +164,14 @@ class FCM(torch.nn.Module):
             self.in_planes = planes * block.expansion
         return torch.nn.Sequential(*layers)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         x = x.unsqueeze(1)
-        out = F.relu(self.bn1(self.conv1(x)))
-        out = self.layer1(out)
-        out = self.layer2(out)
-        out = F.relu(self.bn2(self.conv2(out)))
+        if mask is not None:
+            mask = mask.unsqueeze(1)  # (B,1,T) => (B,1,1,T)
+        out = F.relu(self.bn1(self.conv1(mask_padding(x, mask))))
+        for layer in (*self.layer1, *self.layer2):
+            out = layer(out, mask)
+        out = F.relu(self.bn2(self.conv2(mask_padding(out, mask))))
 
         shape = out.shape
         out = out.reshape(shape[0], shape[1] * shape[2], shape[3])
@@ -143,9 +194,16 @@ def get_nonlinear(config_str, channels):
     return nonlinear
 
 
-def statistics_pooling(x, dim=-1, keepdim=False, unbiased=True, eps=1e-2):
-    mean = x.mean(dim=dim)
-    std = x.std(dim=dim, unbiased=unbiased)
+def statistics_pooling(x, dim=-1, keepdim=False, unbiased=True, eps=1e-2, mask=None):
+    if mask is None:
+        mean = x.mean(dim=dim)
+        std = x.std(dim=dim, unbiased=unbiased)
+    else:
+        # statistics over the valid frames only
+        n = mask.sum(dim=dim)
+        mean = (x * mask).sum(dim=dim) / n
+        var = ((x - mean.unsqueeze(dim)).pow(2) * mask).sum(dim=dim) / (n - 1 if unbiased else n)
+        std = var.sqrt()
     stats = torch.cat([mean, std], dim=-1)
     if keepdim:
         stats = stats.unsqueeze(dim=dim)
@@ -153,8 +211,8 @@ def statistics_pooling(x, dim=-1, keepdim=False, unbiased=True, eps=1e-2):
 
 
 class StatsPool(torch.nn.Module):
-    def forward(self, x):
-        return statistics_pooling(x)
+    def forward(self, x, mask=None):
+        return statistics_pooling(x, mask=mask)
 
 
 class TDNNLayer(torch.nn.Module):
@@ -186,11 +244,16 @@ class TDNNLayer(torch.nn.Module):
         )
         self.nonlinear = get_nonlinear(config_str, out_channels)
 
-    def forward(self, x):
-        x = self.linear(x)
+    def forward(self, x, mask=None):
+        x = self.linear(mask_padding(x, mask))
         x = self.nonlinear(x)
         return x
 
+    def output_lengths(self, lengths):
+        conv = self.linear
+        padding, dilation, kernel_size, stride = conv.padding[0], conv.dilation[0], conv.kernel_size[0], conv.stride[0]
+        return (lengths + 2 * padding - dilation * (kernel_size - 1) - 1).div(stride, rounding_mode="floor") + 1
+
 
 class CAMLayer(torch.nn.Module):
     def __init__(
@@ -211,17 +274,28 @@ class CAMLayer(torch.nn.Module):
         self.linear2 = torch.nn.Conv1d(bn_channels // reduction, out_channels, 1)
         self.sigmoid = torch.nn.Sigmoid()
 
-    def forward(self, x):
-        y = self.linear_local(x)
-        context = x.mean(-1, keepdim=True) + self.seg_pooling(x)
+    def forward(self, x, mask=None):
+        if mask is None:
+            y = self.linear_local(x)
+            context = x.mean(-1, keepdim=True) + self.seg_pooling(x)
+        else:
+            x = mask_padding(x, mask)
+            y = self.linear_local(x)
+            context = x.sum(-1, keepdim=True) / mask.sum(-1, keepdim=True) + self.seg_pooling(x, mask=mask)
         context = self.relu(self.linear1(context))
         m = self.sigmoid(self.linear2(context))
         return y * m
 
-    def seg_pooling(self, x, seg_len=100, stype="avg"):
+    def seg_pooling(self, x, seg_len=100, stype="avg", mask=None):
         if stype == "avg":
             seg = F.avg_pool1d(x, kernel_size=seg_len, stride=seg_len, ceil_mode=True)
+            if mask is not None:
+                # average over the valid frames of each segment (x is zero past them)
+                valid = F.avg_pool1d(mask, kernel_size=seg_len, stride=seg_len, ceil_mode=True)
+                seg = seg / valid.clamp(min=1.0 / seg_len)
         elif stype == "max":
+            if mask is not None:
+                x = x.masked_fill(mask == 0, float("-inf"))
             seg = F.max_pool1d(x, kernel_size=seg_len, stride=seg_len, ceil_mode=True)
         else:
             raise ValueError("Wrong segment pooling type.")
@@ -266,12 +340,12 @@ class CAMDenseTDNNLayer(torch.nn.Module):
     def bn_function(self, x):
         return self.linear1(self.nonlinear1(x))
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         if self.training and self.memory_efficient:
             x = cp.checkpoint(self.bn_function, x)
         else:
             x = self.bn_function(x)
-        x = self.cam_layer(self.nonlinear2(x))
+        x = self.cam_layer(self.nonlinear2(x), mask)
         return x
 
 
@@ -304,9 +378,9 @@ class CAMDenseTDNNBlock(torch.nn.ModuleList):
             )
             self.add_module("tdnnd%d" % (i + 1), layer)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         for layer in self:
-            x = torch.cat([x, layer(x)], dim=1)
+            x = torch.cat([x, layer(x, mask)], dim=1)
         return x
 
 
@@ -414,15 +488,38 @@ class CAMPPlus(torch.nn.Module):
                 if m.bias is not None:
                     torch.nn.init.zeros_(m.bias)
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
+        """
+        x: padded features (B,T,F)
+        lengths: number of valid frames of each row (B,). Without them, every frame is used, padding included.
+        """
         x = x.permute(0, 2, 1)  # (B,T,F) => (B,F,T)
-        x = self.head(x)
-        x = self.xvector(x)
+        mask = None
+        if lengths is not None:
+            lengths = torch.as_tensor(lengths, device=x.device)
+            mask = (torch.arange(x.shape[-1], device=x.device) < lengths.unsqueeze(1)).unsqueeze(1).to(x.dtype)
+
+        x = self.head(x, mask)
+        for layer in self.xvector:
+            if isinstance(layer, TDNNLayer):
+                x = layer(x, mask)
+                if mask is not None:
+                    lengths = layer.output_lengths(lengths)
+                    mask = (torch.arange(x.shape[-1], device=x.device) < lengths.unsqueeze(1)).unsqueeze(1).to(x.dtype)
+            elif isinstance(layer, (CAMDenseTDNNBlock, StatsPool)):
+                x = layer(x, mask)
+            else:
+                x = layer(x)
         if self.output_level == "frame":
             x = x.transpose(1, 2)
         return x
 
-    def inference(self, audio_list):
-        speech, speech_lengths, speech_times = extract_feature(audio_list)
-        results = self.forward(speech.to(torch.float32))
+    def inference(self, audio_list, audio_lens=None):
+        """
+        audio_list: list of 16kHz waveforms, or padded waveforms (B,T) with their lengths `audio_lens`
+        """
+        speech, speech_lengths, speech_times = extract_feature(audio_list, audio_lens)
+        # the padding of a batch is masked throughout the network, so that each x-vector only depends on its audio
+        lengths = speech_lengths if min(speech_lengths) < speech.shape[1] else None
+        results = self.forward(speech.to(torch.float32), lengths)
         return results
@@ -1,10 +1,10 @@
-from typing import List, Tuple
+from typing import List, Optional, Tuple, Union
 
 import numpy as np
 import librosa
 import torch
 import torch.nn.functional as F
-from s3tokenizer.utils import padding
+from torch.nn.utils.rnn import pad_sequence
 from s3tokenizer.model_v2 import (
     S3TokenizerV2,
     ModelConfig,
@@ -22,7 +22,7 @@ SPEECH_VOCAB_SIZE = 6561
 class S3Tokenizer(S3TokenizerV2):
     """
     s3tokenizer.S3TokenizerV2 with the following changes:
-    - a more integrated `forward`
+    - a more integrated, batched `forward`
     - compute `log_mel_spectrogram` using `_mel_filters` and `window` in `register_buffers`
     """
 
@@ -90,41 +90,88 @@ class S3Tokenizer(S3TokenizerV2):
     @torch.no_grad()
     def forward(
         self,
-        wavs: torch.Tensor,
+        wavs: Union[torch.Tensor, List],
         accelerator: 'Accelerator'=None,
         max_len: int=None,
+        wav_lens: Optional[torch.LongTensor]=None,
     ) -> Tuple[torch.Tensor, torch.LongTensor]:
         """
         NOTE: mel-spec has a hop size of 160 points (100 frame/sec).
-        FIXME: this class inherits `nn.Module` but doesn't accept `torch.Tensor` and handles a list of wavs one by one, which is unexpected.
 
         Args
         ----
-        - `wavs`: 16 kHz speech audio
+        - `wavs`: 16 kHz speech audio, either a list of wavs or a padded batch [B, T] (or [T])
         - `max_len` max length to truncate the output sequence to (25 token/sec).
+        - `wav_lens`: the lengths of the wavs of a padded batch [B], by default all of `T`
         NOTE: please pad the waveform if longer sequence is needed.
+
+        The whole batch goes through `log_mel_spectrogram_batch` and `quantize` at once.
         """
-        processed_wavs = self._prepare_audio(wavs)
-        mels, mel_lens = [], []
-        for wav in processed_wavs:
-            wav = wav.to(self.device)
-            mel = self.log_mel_spectrogram(wav)  # [B=1, F, T]
-            if max_len is not None:
-                mel = mel[..., :max_len * 4]  # num_mel_frames = 4 * num_tokens
-            mels.append(mel.squeeze(0))
-
-        mels, mel_lens = padding(mels)
+        if torch.is_tensor(wavs):
+            wavs = wavs.to(self.device)
+            if wavs.dim() == 1:
+                wavs = wavs.unsqueeze(0)
+            if wav_lens is None:
+                wav_lens = torch.full((wavs.size(0),), wavs.size(1), dtype=torch.long)
+        else:
+            processed_wavs = self._prepare_audio(wavs)
+            wav_lens = torch.tensor([wav.shape[-1] for wav in processed_wavs])
+            wavs = pad_sequence([wav[0] for wav in processed_wavs], batch_first=True).to(self.device)
+
+        mels, mel_lens = self.log_mel_spectrogram_batch(wavs, wav_lens.to(self.device))
+        if max_len is not None:
+            mels = mels[..., :max_len * 4]  # num_mel_frames = 4 * num_tokens
+            mel_lens = mel_lens.clamp(max=max_len * 4)
+        mels = mels[..., :int(mel_lens.max())]
+
         if accelerator is None:
             tokenizer = self
         else:
             tokenizer = accelerator.unwrap_model(self)
 
-        speech_tokens, speech_token_lens = tokenizer.quantize(mels, mel_lens.to(self.device))
+        speech_tokens, speech_token_lens = tokenizer.quantize(mels, mel_lens.int())
         return (
             speech_tokens.long().detach(),
             speech_token_lens.long().detach(),
         )
 
+    def log_mel_spectrogram_batch(self, audio: torch.Tensor, audio_lens: torch.LongTensor):
+        """
+        Batched `log_mel_spectrogram` of a padded batch of 16 kHz wavs [B, T] with lengths `audio_lens` [B].
+        Every row is the same as `log_mel_spectrogram` of the unpadded wav: it is reflect-padded at its own end,
+        and normalized by its own max. Frames past a row's length are zero.
+
+        Returns the log-Mel spectrograms [B, n_mels, n_frames] and the number of frames of every row [B].
+        """
+        # centered frames, with the reflect padding of `torch.stft` applied at the end of every row
+        pad = self.n_fft // 2
+        pos = torch.arange(-pad, audio.size(1) + pad, device=audio.device).unsqueeze(0)
+        last = (audio_lens - 1).unsqueeze(1)
+        idx = torch.where(pos < 0, -pos, torch.where(pos > last, 2 * last - pos, pos))
+        audio = audio.gather(1, idx.clamp(min=0, max=audio.size(1) - 1))
+
+        stft = torch.stft(
+            audio, self.n_fft, S3_HOP,
+            window=self.window.to(self.device),
+            center=False,
+            return_complex=True
+        )
+        magnitudes = stft.abs()**2
+
+        mel_spec = self._mel_filters.to(self.device) @ magnitudes
+
+        # the last frame of `log_mel_spectrogram` is dropped
+        mel_lens = audio_lens // S3_HOP
+        mel_spec = mel_spec[..., :int(mel_lens.max())]
+        mask = torch.arange(mel_spec.size(-1), device=mel_spec.device) < mel_lens.unsqueeze(1)
+        mask = mask.unsqueeze(1)
+
+        log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+        log_spec_max = log_spec.masked_fill(~mask, float("-inf")).amax(dim=(1, 2), keepdim=True)
+        log_spec = torch.maximum(log_spec, log_spec_max - 8.0)
+        log_spec = (log_spec + 4.0) / 4.0
+        return log_spec * mask, mel_lens
+
     def log_mel_spectrogram(
         self,
         audio: torch.Tensor,
@@ -54,6 +54,7 @@ class AlignmentStreamAnalyzer:
         # using it for all layers slows things down too much. We can apply it to just one layer
         # by intercepting the kwargs and adding a forward hook (credit: jrm)
         self.last_aligned_attn = None
+        self._spy = None
         self._add_attention_spy(tfmr, alignment_layer_idx)
 
     def _add_attention_spy(self, tfmr, alignment_layer_idx):
@@ -71,8 +72,8 @@ class AlignmentStreamAnalyzer:
             - When `output_attentions=True`, `LlamaSdpaAttention.forward` calls `LlamaAttention.forward`.
             - `attn_output` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
             """
-            step_attention = output[1].cpu() # (B, 16, N, N)
-            self.last_aligned_attn = step_attention[0].mean(0) # (N, N)
+            step_attention = output[1][0].mean(0) # (N, N), only the conditional row is used
+            self.last_aligned_attn = step_attention.cpu()
 
         target_layer = tfmr.layers[alignment_layer_idx].self_attn
         hook_handle = target_layer.register_forward_hook(attention_forward_hook)
@@ -83,8 +84,20 @@ class AlignmentStreamAnalyzer:
             kwargs['output_attentions'] = True
             return original_forward(*args, **kwargs)
 
-        # TODO: how to unpatch it?
         target_layer.forward = MethodType(patched_forward, target_layer)
+        self._spy = (target_layer, hook_handle)
+
+    def remove_attention_spy(self):
+        """
+        Removes the forward hook and restores the original forward of the attention layer, so that it goes
+        back to the optimized attention kernel.
+        """
+        if self._spy is None:
+            return
+        target_layer, hook_handle = self._spy
+        hook_handle.remove()
+        del target_layer.forward  # drop the instance-level patch, falling back to the class method
+        self._spy = None
 
     def step(self, logits):
         """
@@ -0,0 +1,93 @@
+from typing import Optional
+
+import torch
+from torch import Tensor
+
+
+class T3Sampler:
+    """
+    On-device sampler for T3 speech tokens, used in place of the HF logits processors. Every step:
+        * CFG: the B conditional rows are mixed with their B unconditional rows (the logits have 2B rows)
+        * temperature
+        * repetition penalty, using a preallocated (B, vocab) presence bitmap instead of re-scanning the
+          generated ids (same semantics as HF's `RepetitionPenaltyLogitsProcessor`)
+        * top-p, with a single descending sort / cumsum; the kept probabilities are scattered back to vocab
+          order before sampling, so that a seeded run draws the same tokens as the HF processors
+    Sampled tokens are written into a preallocated (B, max_new_tokens) buffer, so nothing is concatenated
+    and nothing is synced to the host: callers decide how often to look for EOS (see `find_eos`).
+    """
+
+    def __init__(
+        self,
+        *,
+        batch_size: int,
+        vocab_size: int,
+        max_new_tokens: int,
+        device,
+        temperature=0.8,
+        top_p=0.8,
+        repetition_penalty=2.0,
+        cfg_weight=0,
+        initial_token: Optional[int]=None,
+    ):
+        self.temperature = temperature
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.cfg_weight = cfg_weight
+
+        self.presence = torch.zeros(batch_size, vocab_size, dtype=torch.bool, device=device)
+        if initial_token is not None:
+            self.presence[:, initial_token] = True  # e.g. BOS, which is part of the generated ids
+        self.tokens = torch.zeros(batch_size, max_new_tokens, dtype=torch.long, device=device)
+        self.n_tokens = 0
+
+    def __call__(self, logits: Tensor) -> Tensor:
+        """
+        Args:
+            logits: (2B, vocab) logits of the last position; conditional rows first, then unconditional rows.
+        Returns:
+            the sampled tokens, shape (B, 1)
+        """
+        # CFG
+        B = logits.size(0) // 2
+        logits_cond, logits_uncond = logits[:B], logits[B:]
+        logits = logits_cond + self.cfg_weight * (logits_cond - logits_uncond)
+
+        if self.temperature != 1.0:
+            logits = logits / self.temperature
+
+        if self.repetition_penalty != 1.0:
+            penalized = torch.where(logits < 0, logits * self.repetition_penalty, logits / self.repetition_penalty)
+            logits = torch.where(self.presence, penalized, logits)
+
+        if self.top_p < 1.0:
+            sorted_logits, sorted_idxs = logits.sort(dim=-1, descending=True)
+            sorted_probs = sorted_logits.softmax(dim=-1)
+            # drop a token once the tokens before it already cover `top_p` (the top token is always kept)
+            mass_before = sorted_probs.cumsum(dim=-1) - sorted_probs
+            sorted_probs = sorted_probs.masked_fill(mass_before >= self.top_p, 0)
+            probs = torch.zeros_like(sorted_probs).scatter_(-1, sorted_idxs, sorted_probs)
+        else:
+            probs = logits.softmax(dim=-1)
+        next_token = torch.multinomial(probs, num_samples=1)
+
+        self.presence.scatter_(1, next_token, True)
+        self.tokens[:, self.n_tokens] = next_token[:, 0]
+        self.n_tokens += 1
+        return next_token  # (B, 1)
+
+    def find_eos(self, eos_idx: int, start: int=0) -> Tensor:
+        """
+        Returns, for every row, the index in `tokens` of the first `eos_idx` sampled at or after `start`,
+        or -1 if there is none. This is the only method that needs a host sync, once per call.
+        """
+        if start >= self.n_tokens:
+            return torch.full((self.tokens.size(0),), -1, dtype=torch.long)
+        is_eos = self.tokens[:, start:self.n_tokens] == eos_idx
+        first = is_eos.int().argmax(dim=-1) + start
+        return torch.where(is_eos.any(dim=-1), first, -1).cpu()
+
+    def select(self, rows: Tensor):
+        "Keep only the given rows, e.g. to retire finished requests from a batch."
+        self.presence = self.presence[rows]
+        self.tokens = self.tokens[rows]
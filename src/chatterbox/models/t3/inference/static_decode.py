@@ -0,0 +1,71 @@
+from typing import Optional
+
+import torch
+from torch import Tensor
+from transformers import StaticCache
+
+
+class T3StaticDecoder:
+    """
+    Opt-in decode engine for `T3.inference`. The KV cache of both CFG rows is preallocated once, up to
+    `max_cache_len` positions, and every step writes into it in place. Since the single-token step always
+    sees the same shapes and addresses, it can be run through `torch.compile` (by default with CUDA graphs,
+    i.e. "reduce-overhead"), which keeps the per-token latency flat on long utterances.
+
+    NOTE: attention still spans the whole preallocated cache (masked), so keep `max_cache_len` close to
+    the longest prompt + generation you need.
+    """
+
+    def __init__(self, t3, max_cache_len: Optional[int]=None, compile_mode: Optional[str]="reduce-overhead"):
+        self.t3 = t3
+        self.max_cache_len = max_cache_len or t3.hp.max_speech_tokens
+        self.device = t3.device
+        self.dtype = t3.speech_head.weight.dtype
+        self.cache = StaticCache(
+            config=t3.cfg,
+            batch_size=2,  # CFG
+            max_cache_len=self.max_cache_len,
+            device=self.device,
+            dtype=self.dtype,
+        )
+        self.seq_len = 0
+
+        self._step = self._forward
+        if compile_mode is not None:
+            self._step = torch.compile(self._forward, mode=compile_mode, fullgraph=True, dynamic=False)
+
+    def matches(self, t3) -> bool:
+        "Whether this engine can still be used with `t3`, e.g. after it was moved to another device."
+        return t3 is self.t3 and t3.device == self.device and t3.speech_head.weight.dtype == self.dtype
+
+    def _forward(self, inputs_embeds: Tensor, cache_position: Tensor):
+        tfmr_out = self.t3.tfmr(
+            inputs_embeds=inputs_embeds,
+            past_key_values=self.cache,
+            cache_position=cache_position,
+            position_ids=cache_position.unsqueeze(0),
+            use_cache=True,
+            return_dict=True,
+        )
+        return self.t3.speech_head(tfmr_out.last_hidden_state[:, -1:])  # (2, 1, vocab)
+
+    def prefill(self, inputs_embeds: Tensor):
+        """
+        Reset the cache and run the whole prompt, shape (2, S, dim). Returns the logits of the last position.
+        The prompt has a variable length, so it always runs eagerly.
+        """
+        seq_len = inputs_embeds.size(1)
+        assert seq_len < self.max_cache_len, f"prompt of {seq_len} tokens does not fit in the static cache"
+        self.cache.reset()
+        cache_position = torch.arange(seq_len, device=self.device)
+        logits = self._forward(inputs_embeds, cache_position)
+        self.seq_len = seq_len
+        return logits
+
+    def step(self, inputs_embeds: Tensor):
+        "Run a single (2, 1, dim) token through the (compiled) decode step, and return its logits."
+        assert self.seq_len < self.max_cache_len, "static cache is full"
+        cache_position = torch.tensor([self.seq_len], device=self.device)
+        logits = self._step(inputs_embeds, cache_position)
+        self.seq_len += 1
+        return logits.clone()  # graph outputs are overwritten on the next replay
@@ -1,14 +1,15 @@
 # Copyright (c) 2025 Resemble AI
 # MIT License
+import hashlib
 import logging
+from collections import OrderedDict
 from typing import Union, Optional, List
 
 from tqdm import tqdm
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
-from transformers import LlamaModel, LlamaConfig
-from transformers.generation.logits_process import TopPLogitsWarper, RepetitionPenaltyLogitsProcessor
+from transformers import LlamaModel, LlamaConfig, DynamicCache
 
 from .modules.learned_pos_emb import LearnedPositionEmbeddings
 
@@ -17,6 +18,8 @@ from .modules.t3_config import T3Config
 from .llama_configs import LLAMA_CONFIGS
 from .inference.t3_hf_backend import T3HuggingfaceBackend
 from .inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+from .inference.static_decode import T3StaticDecoder
+from .inference.sampler import T3Sampler
 
 
 logger = logging.getLogger(__name__)
@@ -42,9 +45,12 @@ class T3(nn.Module):
         * careful! this class assumes relative positional encoding -- with absolute PE, we would at
             least want to reset the position to 0 when speech tokens begin, and optionally use a
             different PE embedding space for speech.
+
+    `prefix_cache_size` is the number of voices whose conditioning prefix KV cache is kept, see
+    `get_cond_prefix_cache` (0 disables it).
     """
 
-    def __init__(self, hp=T3Config()):
+    def __init__(self, hp=T3Config(), prefix_cache_size=8):
         super().__init__()
         self.hp = hp
         self.cfg = LlamaConfig(**LLAMA_CONFIGS[hp.llama_config_name])
@@ -69,6 +75,12 @@ class T3(nn.Module):
         self.text_head = nn.Linear(self.cfg.hidden_size, hp.text_tokens_dict_size, bias=False)
         self.speech_head = nn.Linear(self.cfg.hidden_size, hp.speech_tokens_dict_size, bias=False)
         self.compiled = False
+        self.static_decoder: Optional[T3StaticDecoder] = None
+
+        # KV cache of the conditioning prefix, per voice (see `get_cond_prefix_cache`)
+        self.prefix_cache = OrderedDict()
+        self.prefix_cache_size = prefix_cache_size
+        self._register_load_state_dict_pre_hook(lambda *args, **kwargs: self.prefix_cache.clear())
 
     @property
     def device(self):
@@ -204,8 +216,83 @@ class T3(nn.Module):
 
         return loss_text, loss_speech
 
+    def _build_patched_model(self, alignment_stream_analyzer: Optional[AlignmentStreamAnalyzer]=None):
+        return T3HuggingfaceBackend(
+            config=self.cfg,
+            llama=self.tfmr,
+            speech_enc=self.speech_emb,
+            speech_head=self.speech_head,
+            alignment_stream_analyzer=alignment_stream_analyzer,
+        )
+
+    def get_static_decoder(self) -> T3StaticDecoder:
+        "Lazily build the static-cache decode engine, and rebuild it if this model moved device / dtype."
+        if self.static_decoder is None or not self.static_decoder.matches(self):
+            self.static_decoder = T3StaticDecoder(self)
+        return self.static_decoder
+
+    def _cond_cache_key(self, t3_cond: T3Cond) -> str:
+        "Content hash of everything that goes into the conditioning prefix, i.e. the voice and `emotion_adv`."
+        h = hashlib.sha1(f"{self.device}/{self.speech_head.weight.dtype}".encode())
+        for v in (t3_cond.speaker_emb, t3_cond.clap_emb, t3_cond.cond_prompt_speech_tokens, t3_cond.emotion_adv):
+            if torch.is_tensor(v):
+                v = v.detach().cpu().contiguous()
+                h.update(f"{v.dtype}{tuple(v.shape)}".encode())
+                h.update(v.view(-1).view(torch.uint8).numpy())
+            else:
+                h.update(repr(v).encode())
+        return h.hexdigest()
+
+    @torch.inference_mode()
+    def get_cond_prefix_cache(self, t3_cond: T3Cond, cond_emb: Tensor) -> DynamicCache:
+        """
+        Returns a KV cache for both CFG rows that already holds the conditioning prefix, so that only the text
+        (and BOS) tokens need to be prefilled. Both rows share the same prefix, so it is computed once with a
+        batch of one, and kept in an LRU of `prefix_cache_size` entries keyed by `_cond_cache_key`.
+
+        Every entry holds the keys and values of all the layers for the prefix: 2 * num_hidden_layers *
+        num_key_value_heads * head_dim values per prefix token, i.e. 240 KB per token in float32 for Llama_520M.
+        The prefix is the speaker embedding, the emotion token and the prompt speech tokens: 34 tokens (~8 MB)
+        with the perceiver resampler, ~37 MB for the 150 prompt tokens without it.
+
+        Args:
+            t3_cond: the conditionals `cond_emb` was computed from.
+            cond_emb: (1, len_cond, dim) conditioning embeddings, from `prepare_conditioning`.
+        """
+        key = self._cond_cache_key(t3_cond)
+        legacy_cache = self.prefix_cache.get(key)
+        if legacy_cache is None:
+            tfmr_out = self.tfmr(
+                inputs_embeds=cond_emb,
+                past_key_values=DynamicCache(),
+                use_cache=True,
+                return_dict=True,
+            )
+            legacy_cache = tfmr_out.past_key_values.to_legacy_cache()
+            self.prefix_cache[key] = legacy_cache
+            while len(self.prefix_cache) > self.prefix_cache_size:
+                self.prefix_cache.popitem(last=False)
+        else:
+            self.prefix_cache.move_to_end(key)
+
+        # NOTE: the cache concatenates on update, so the shared (expanded) entries are never written to
+        return DynamicCache.from_legacy_cache(tuple(
+            (k.expand(2, -1, -1, -1), v.expand(2, -1, -1, -1)) for k, v in legacy_cache
+        ))
+
     @torch.inference_mode()
-    def inference(
+    def inference(self, **kwargs):
+        """
+        Args:
+            text_tokens: a 1D (unbatched) or 2D (batched) tensor.
+        See `inference_stream` for the other arguments.
+        """
+        # Concatenate all predicted tokens along the sequence dimension.
+        predicted_tokens = torch.cat(list(self.inference_stream(**kwargs)), dim=1)  # shape: (B, num_tokens)
+        return predicted_tokens
+
+    @torch.inference_mode()
+    def inference_stream(
         self,
         *,
         t3_cond: T3Cond,
@@ -225,15 +312,35 @@ class T3(nn.Module):
         length_penalty=1.0,
         repetition_penalty=2.0,
         cfg_weight=0,
+
+        # decode engine
+        use_static_cache=False,
+        use_alignment_analyzer=False,
+        eos_check_interval=1,
+        use_prefix_cache=True,
     ):
         """
+        Same as `inference`, but yields the predicted tokens while sampling, in chunks of shape (1, n).
+        The last token yielded is the stop token, unless `max_new_tokens` was reached first.
+
         Args:
             text_tokens: a 1D (unbatched) or 2D (batched) tensor.
+            eos_check_interval: look for EOS (which syncs with the host) and yield the new tokens every this
+                many steps. Tokens sampled after EOS are dropped, so larger values only waste a few steps.
+            use_prefix_cache: reuse the KV cache of the conditioning prefix across calls with the same voice
+                (see `get_cond_prefix_cache` for its memory cost). Not used together with the static cache or
+                alignment analyzer, nor when the model's `prefix_cache_size` is 0.
+            use_static_cache: decode with the preallocated KV cache and compiled step of `T3StaticDecoder`.
+                `max_new_tokens` is clamped to what fits in its cache.
+            use_alignment_analyzer: run the `AlignmentStreamAnalyzer` hallucination checks, which capture the
+                attention map of a single layer.
         """
+        assert not (use_static_cache and use_alignment_analyzer), "the alignment analyzer needs the dynamic cache"
         # Validate / sanitize inputs
         assert prepend_prompt_speech_tokens is None, "not implemented"
         _ensure_BOT_EOT(text_tokens, self.hp)
         text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=self.device)
+        max_new_tokens = max_new_tokens or self.hp.max_speech_tokens
 
         # Default initial speech to a single start-of-speech token
         if initial_speech_tokens is None:
@@ -254,19 +361,17 @@ class T3(nn.Module):
         # TODO? synchronize the expensive compile function
         # with self.compile_lock:
         if not self.compiled:
-            # alignment_stream_analyzer = AlignmentStreamAnalyzer(
-            #     self.tfmr,
-            #     None,
-            #     text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
-            #     alignment_layer_idx=9, # TODO: hparam or something?
-            #     eos_idx=self.hp.stop_speech_token,
-            # )
-            patched_model = T3HuggingfaceBackend(
-                config=self.cfg,
-                llama=self.tfmr,
-                speech_enc=self.speech_emb,
-                speech_head=self.speech_head,
-                # alignment_stream_analyzer=alignment_stream_analyzer,
+            alignment_stream_analyzer = None
+            if use_alignment_analyzer:
+                alignment_stream_analyzer = AlignmentStreamAnalyzer(
+                    self.tfmr,
+                    None,
+                    text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
+                    alignment_layer_idx=9, # TODO: hparam or something?
+                    eos_idx=self.hp.stop_speech_token,
+                )
+            patched_model = self._build_patched_model(
+                alignment_stream_analyzer=alignment_stream_analyzer,
             )
             self.patched_model = patched_model
             self.compiled = True
@@ -300,73 +405,223 @@ class T3(nn.Module):
         # Combine condition and BOS token for the initial input
         inputs_embeds = torch.cat([embeds, bos_embed], dim=1)
 
-        # Track generated token ids; start with the BOS token.
-        generated_ids = bos_token.clone()
-        predicted = []  # To store the predicted tokens
+        static_decoder = None
+        if use_static_cache:
+            static_decoder = self.get_static_decoder()
+            max_fit = static_decoder.max_cache_len - inputs_embeds.size(1)
+            if max_new_tokens > max_fit:
+                logger.warning(f"max_new_tokens={max_new_tokens} does not fit in the static cache, using {max_fit}")
+                max_new_tokens = max_fit
+
+        # CFG, temperature, repetition penalty (BOS counts as generated) and top-p, all on device
+        sampler = T3Sampler(
+            batch_size=1,
+            vocab_size=self.hp.speech_tokens_dict_size,
+            max_new_tokens=max_new_tokens,
+            device=device,
+            temperature=temperature,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+            initial_token=self.hp.start_speech_token,
+        )
 
-        # Instantiate the logits processors.
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty)
+        try:
+            # ---- Initial Forward Pass (no kv_cache yet, or only the conditioning prefix) ----
+            if static_decoder is not None:
+                output = AttrDict(logits=static_decoder.prefill(inputs_embeds))
+            else:
+                past = DynamicCache()
+                if use_prefix_cache and self.prefix_cache_size > 0 and alignment_stream_analyzer is None:
+                    past = self.get_cond_prefix_cache(t3_cond, embeds[:1, :len_cond])
+                    inputs_embeds = inputs_embeds[:, len_cond:]
+                output = self.patched_model(
+                    inputs_embeds=inputs_embeds,
+                    past_key_values=past,
+                    use_cache=True,
+                    return_dict=True,
+                    num_logits_to_keep=1,
+                )
+                # Initialize kv_cache with the full context.
+                past = output.past_key_values
+
+            # ---- Generation Loop using kv_cache ----
+            n_yielded = 0
+            for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
+                next_token = sampler(output.logits[:, -1, :])  # shape: (1, 1)
+
+                # Check for EOS token, and hand out the new tokens up to it.
+                last_step = i == max_new_tokens - 1
+                if (i + 1) % eos_check_interval == 0 or last_step:
+                    eos_pos = sampler.find_eos(self.hp.stop_speech_token, start=n_yielded)[0].item()
+                    end = sampler.n_tokens if eos_pos < 0 else eos_pos + 1
+                    yield sampler.tokens[:, n_yielded:end]
+                    n_yielded = end
+                    if eos_pos >= 0 or last_step:
+                        break
+
+                # Get embedding for the new token.
+                next_token_embed = self.speech_emb(next_token)
+                next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(i + 1)
+
+                #  For CFG
+                next_token_embed = torch.cat([next_token_embed, next_token_embed])
+
+                # Forward pass with only the new token and the cached past.
+                if static_decoder is not None:
+                    output = AttrDict(logits=static_decoder.step(next_token_embed))
+                    continue
+                output = self.patched_model(
+                    inputs_embeds=next_token_embed,
+                    past_key_values=past,
+                    return_dict=True,
+                    num_logits_to_keep=1,
+                )
+                # Update the kv_cache.
+                past = output.past_key_values
+        finally:
+            if alignment_stream_analyzer is not None:
+                alignment_stream_analyzer.remove_attention_spy()
 
-        # ---- Initial Forward Pass (no kv_cache yet) ----
-        output = self.patched_model(
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        *,
+        t3_cond: Union[T3Cond, List[T3Cond]],
+        text_tokens: List[Tensor],
+        max_new_tokens=None,
+        temperature=0.8,
+        top_p=0.8,
+        repetition_penalty=2.0,
+        cfg_weight=0,
+        eos_check_interval=1,
+    ) -> List[Tensor]:
+        """
+        Decode several independent requests in one batch. Each request gets a conditional and a CFG
+        unconditional row, so N requests run as 2N rows: rows [0, N) are conditional, rows [N, 2N) are
+        unconditional. Prompts are left-padded, and requests are retired from the batch once they emit EOS.
+
+        Args:
+            t3_cond: a single `T3Cond` shared by all requests, or a list with one per request.
+            text_tokens: list of 1D text token tensors, each including the start / stop text tokens.
+            eos_check_interval: look for EOS (which syncs with the host) and retire finished requests every this
+                many steps.
+        Returns:
+            list of 1D speech token tensors, one per request, in input order. Each ends with the stop
+            token, unless `max_new_tokens` was reached first.
+        """
+        n = len(text_tokens)
+        t3_conds = list(t3_cond) if isinstance(t3_cond, (list, tuple)) else [t3_cond] * n
+        assert len(t3_conds) == n, "need one T3Cond per request"
+        max_new_tokens = max_new_tokens or self.hp.max_speech_tokens
+        device = self.device
+
+        bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=device)
+        bos_embed = self.speech_emb(bos_token) + self.speech_pos_emb.get_fixed_embedding(0)
+        bos_embed = bos_embed[0].expand(2, -1)  # (2, dim), `inference` also feeds BOS twice
+
+        # Build the [cond | text | BOS BOS] prompt of every row
+        cond_rows, uncond_rows = [], []
+        for cond, tokens in zip(t3_conds, text_tokens):
+            tokens = torch.atleast_2d(tokens).to(dtype=torch.long, device=device)
+            _ensure_BOT_EOT(tokens, self.hp)
+            cond_emb = self.prepare_conditioning(cond)[0]  # (len_cond, dim)
+            text_emb = self.text_emb(tokens)[0]  # (len_text, dim)
+            text_pos = torch.zeros_like(text_emb)
+            if self.hp.input_pos_emb == "learned":
+                text_pos = self.text_pos_emb(tokens)
+            cond_rows.append(torch.cat([cond_emb, text_emb + text_pos, bos_embed]))
+            uncond_rows.append(torch.cat([cond_emb, text_pos, bos_embed]))  # CFG uncond: text embedding zeroed
+        rows = cond_rows + uncond_rows
+
+        # Left-pad so that every row ends with its BOS tokens, and give each row its own position ids
+        max_len = max(row.size(0) for row in rows)
+        inputs_embeds = bos_embed.new_zeros(2 * n, max_len, self.dim)
+        attention_mask = torch.zeros(2 * n, max_len, dtype=torch.long, device=device)
+        for j, row in enumerate(rows):
+            inputs_embeds[j, max_len - row.size(0):] = row
+            attention_mask[j, max_len - row.size(0):] = 1
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+        patched_model = self._build_patched_model()
+        sampler = T3Sampler(
+            batch_size=n,
+            vocab_size=self.hp.speech_tokens_dict_size,
+            max_new_tokens=max_new_tokens,
+            device=device,
+            temperature=temperature,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+            initial_token=self.hp.start_speech_token,
+        )
+
+        # ---- Initial Forward Pass ----
+        output = patched_model(
             inputs_embeds=inputs_embeds,
-            past_key_values=None,
+            past_key_values=DynamicCache(),
+            attention_mask=attention_mask,
+            position_ids=position_ids,
             use_cache=True,
-            output_attentions=True,
-            output_hidden_states=True,
             return_dict=True,
+            num_logits_to_keep=1,
         )
-        # Initialize kv_cache with the full context.
         past = output.past_key_values
+        next_pos = position_ids[:, -1:] + 1
+
+        active = list(range(n))  # request index of each active conditional row
+        results: List[Optional[Tensor]] = [None] * n
+        checked = 0  # tokens before this index are known to be EOS-free
 
         # ---- Generation Loop using kv_cache ----
         for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
-            logits = output.logits[:, -1, :]
-
-            # CFG
-            logits_cond = logits[0:1]
-            logits_uncond = logits[1:2]
-            logits = logits_cond + cfg_weight * (logits_cond - logits_uncond)
-            logits = logits.squeeze(1)
-
-            # Apply temperature scaling.
-            if temperature != 1.0:
-                logits = logits / temperature
-
-            # Apply repetition penalty and top‑p filtering.
-            logits = repetition_penalty_processor(generated_ids, logits)
-            logits = top_p_warper(None, logits)
-
-            # Convert logits to probabilities and sample the next token.
-            probs = torch.softmax(logits, dim=-1)
-            next_token = torch.multinomial(probs, num_samples=1)  # shape: (B, 1)
-
-            predicted.append(next_token)
-            generated_ids = torch.cat([generated_ids, next_token], dim=1)
-
-            # Check for EOS token.
-            if next_token.view(-1) == self.hp.stop_speech_token:
+            next_token = sampler(output.logits[:, -1, :])  # (m, 1)
+            if i == max_new_tokens - 1:
                 break
 
-            # Get embedding for the new token.
-            next_token_embed = self.speech_emb(next_token)
-            next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(i + 1)
-
-            #  For CFG
+            # Retire the requests that emitted EOS since the last check
+            if (i + 1) % eos_check_interval == 0:
+                eos_pos = sampler.find_eos(self.hp.stop_speech_token, start=checked).tolist()
+                checked = sampler.n_tokens
+                if any(p >= 0 for p in eos_pos):
+                    keep = []
+                    for j, p in enumerate(eos_pos):
+                        if p >= 0:
+                            results[active[j]] = sampler.tokens[j, :p + 1]
+                        else:
+                            keep.append(j)
+                    if not keep:
+                        break
+                    m = len(eos_pos)
+                    active = [active[j] for j in keep]
+                    keep = torch.tensor(keep, device=device)
+                    keep_rows = torch.cat([keep, keep + m])
+                    sampler.select(keep)
+                    next_token = next_token[keep]
+                    past.batch_select_indices(keep_rows)
+                    attention_mask = attention_mask[keep_rows]
+                    next_pos = next_pos[keep_rows]
+
+            # Embed the new tokens; all rows start speech together, so they share the speech position
+            next_token_embed = self.speech_emb(next_token) + self.speech_pos_emb.get_fixed_embedding(i + 1)
             next_token_embed = torch.cat([next_token_embed, next_token_embed])
+            attention_mask = F.pad(attention_mask, (0, 1), value=1)
 
-            # Forward pass with only the new token and the cached past.
-            output = self.patched_model(
+            output = patched_model(
                 inputs_embeds=next_token_embed,
                 past_key_values=past,
-                output_attentions=True,
-                output_hidden_states=True,
+                attention_mask=attention_mask,
+                position_ids=next_pos,
                 return_dict=True,
+                num_logits_to_keep=1,
             )
-            # Update the kv_cache.
             past = output.past_key_values
-
-        # Concatenate all predicted tokens along the sequence dimension.
-        predicted_tokens = torch.cat(predicted, dim=1)  # shape: (B, num_tokens)
-        return predicted_tokens
+            next_pos = next_pos + 1
+
+        # Requests still active at the end: truncate at an unchecked EOS, if any
+        eos_pos = sampler.find_eos(self.hp.stop_speech_token, start=checked).tolist()
+        for j, req in enumerate(active):
+            if results[req] is None:
+                end = sampler.n_tokens if eos_pos[j] < 0 else eos_pos[j] + 1
+                results[req] = sampler.tokens[j, :end]
+        return results
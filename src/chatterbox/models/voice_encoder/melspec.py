@@ -1,8 +1,13 @@
 from functools import lru_cache
+from typing import Optional
 
 from scipy import signal
 import numpy as np
 import librosa
+import torch
+import torch.nn.functional as F
+import torchaudio as ta
+from torch import nn
 
 
 @lru_cache()
@@ -76,3 +81,125 @@ def _normalize(s, hp, headroom_db=15):
     min_level_db = 20 * np.log10(hp.stft_magnitude_min)
     s = (s - min_level_db) / (-min_level_db + headroom_db)
     return s
+
+
+def _reflect_pad_rows(x, lens, pad):
+    """
+    Reflect-pad every row of a padded batch (B, T) by `pad` samples on both sides, at its own length `lens`,
+    i.e. the `np.pad(..., mode="reflect")` of every unpadded row. Returns (B, T + 2 * pad).
+    """
+    out = F.pad(x.unsqueeze(1), (pad, pad), mode="reflect").squeeze(1)
+    # rows shorter than T: write the reflection of their tail right after their end
+    k = torch.arange(pad, device=x.device)
+    src = (lens.unsqueeze(1) - 2 - k).clamp(min=0)
+    dst = lens.unsqueeze(1) + pad + k
+    return out.scatter_(1, dst, x.gather(1, src))
+
+
+class MelFrontEnd(nn.Module):
+    """
+    Batched torch version of the `VoiceEncoder` front end: `librosa.resample` ("kaiser_fast"),
+    `librosa.effects.trim` and `melspectrogram`, on a padded batch of wavs (B, T) with their lengths (B,).
+    The mel basis and the STFT window are cached as (non-persistent) buffers.
+
+    Trimming and the mels match librosa up to float32 rounding (reflect padding is applied at every row's
+    own length, so rows do not see the batch padding). Resampling uses torchaudio's Kaiser-windowed sinc
+    with the parameters of resampy's "kaiser_fast", which is close but not bit-exact.
+    """
+
+    def __init__(self, hp):
+        super().__init__()
+        self.hp = hp
+        self.register_buffer("mel_basis", torch.from_numpy(mel_basis(hp)).float(), persistent=False)
+        # librosa's default "hann" STFT window is periodic
+        self.register_buffer("window", torch.hann_window(hp.win_size), persistent=False)
+
+    def resample(self, wavs, lens, sample_rate):
+        "Resample to `hp.sample_rate`; the batch padding is zeros, as beyond the end of a row for resampy."
+        wavs = ta.functional.resample(
+            wavs, sample_rate, self.hp.sample_rate,
+            lowpass_filter_width=16, rolloff=0.85, resampling_method="sinc_interp_kaiser", beta=8.555,
+        )
+        lens = torch.ceil(lens * self.hp.sample_rate / sample_rate).long()
+        return wavs, lens
+
+    def trim(self, wavs, lens, top_db=60, frame_length=2048, hop_length=512):
+        "Trim the leading and trailing silence of every row, as `librosa.effects.trim`."
+        # frame RMS, with the constant (zero) padding of `librosa.feature.rms`
+        power = F.avg_pool1d(
+            F.pad(wavs.unsqueeze(1), (frame_length // 2, frame_length // 2)) ** 2, frame_length, hop_length,
+        ).squeeze(1)
+        rms = torch.sqrt(power)
+        frame_idx = torch.arange(rms.size(1), device=wavs.device)
+        valid = frame_idx < (1 + lens // hop_length).unsqueeze(1)
+
+        # dB relative to the loudest frame of the row, as `librosa.amplitude_to_db(rms, ref=np.max)`
+        amin = 1e-10
+        ref = rms.masked_fill(~valid, 0).amax(dim=1, keepdim=True)
+        db = 10 * torch.log10(torch.clamp(rms ** 2, min=amin)) - 10 * torch.log10(torch.clamp(ref ** 2, min=amin))
+        non_silent = (db > -top_db) & valid
+
+        first = torch.where(non_silent, frame_idx, rms.size(1)).amin(dim=1)
+        last = torch.where(non_silent, frame_idx, -1).amax(dim=1)
+        start = torch.where(non_silent.any(dim=1), first * hop_length, 0)
+        end = torch.where(non_silent.any(dim=1), torch.minimum(lens, (last + 1) * hop_length), 0)
+
+        # left-align the trimmed rows
+        lens = end - start
+        idx = start.unsqueeze(1) + torch.arange(int(lens.max()), device=wavs.device)
+        wavs = wavs.gather(1, idx.clamp(max=wavs.size(1) - 1))
+        wavs = wavs * (idx < end.unsqueeze(1))
+        return wavs, lens
+
+    def melspectrogram(self, wavs, lens):
+        """
+        `melspectrogram` of every row. Returns the mels (B, T', M), zero past every row's number of frames,
+        and the numbers of frames (B,).
+        """
+        hp = self.hp
+        if hp.preemphasis > 0:
+            # `signal.lfilter([1, -hp.preemphasis], [1], wav)`
+            wavs = torch.clamp(wavs - hp.preemphasis * F.pad(wavs, (1, 0))[:, :-1], -1, 1)
+
+        # centered frames, with the reflect padding applied at the end of every row
+        spec = torch.stft(
+            _reflect_pad_rows(wavs, lens, hp.n_fft // 2),
+            hp.n_fft,
+            hop_length=hp.hop_size,
+            win_length=hp.win_size,
+            window=self.window,
+            center=False,
+            return_complex=True,
+        )
+        if hp.mel_power == 2.0:
+            # the power spectrum, without the square root of `abs`
+            spec_magnitudes = torch.addcmul(spec.real * spec.real, spec.imag, spec.imag)
+        else:
+            spec_magnitudes = spec.abs() ** hp.mel_power
+
+        mel = self.mel_basis @ spec_magnitudes
+        if hp.mel_type == "db":
+            mel = 20 * torch.log10(torch.clamp(mel, min=hp.stft_magnitude_min))
+        if hp.normalized_mels:
+            min_level_db = 20 * np.log10(hp.stft_magnitude_min)
+            headroom_db = 15
+            mel = (mel - min_level_db) / (-min_level_db + headroom_db)
+
+        mel_lens = 1 + lens // hp.hop_size
+        mel = mel[..., :int(mel_lens.max())]
+        mel = mel * (torch.arange(mel.size(-1), device=mel.device) < mel_lens.unsqueeze(1)).unsqueeze(1)
+        return mel.transpose(1, 2), mel_lens
+
+    @torch.inference_mode()
+    def forward(self, wavs, lens, sample_rate, trim_top_db: Optional[float] = 20):
+        """
+        :param wavs: padded batch of wavs (B, T)
+        :param lens: the length of every wav (B,)
+        :return: the unscaled mels (B, T', M), and the number of frames of every mel (B,)
+        """
+        wavs = wavs.float()
+        if sample_rate != self.hp.sample_rate:
+            wavs, lens = self.resample(wavs, lens, sample_rate)
+        if trim_top_db:
+            wavs, lens = self.trim(wavs, lens, top_db=trim_top_db)
+        return self.melspectrogram(wavs, lens)
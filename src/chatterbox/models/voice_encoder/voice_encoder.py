@@ -4,13 +4,12 @@ from typing import List, Union, Optional
 
 import numpy as np
 from numpy.lib.stride_tricks import as_strided
-import librosa
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
 
 from .config import VoiceEncConfig
-from .melspec import melspectrogram
+from .melspec import MelFrontEnd
 
 
 def pack(arrays, seq_len: int=None, pad_value=0):
@@ -132,6 +131,9 @@ class VoiceEncoder(nn.Module):
         self.similarity_weight = nn.Parameter(torch.tensor([10.]), requires_grad=True)
         self.similarity_bias = nn.Parameter(torch.tensor([-5.]), requires_grad=True)
 
+        # wavs -> mels, see `embeds_from_wavs`
+        self.front_end = MelFrontEnd(hp)
+
     @property
     def device(self):
         return next(self.parameters()).device
@@ -178,25 +180,28 @@ class VoiceEncoder(nn.Module):
             pad = torch.full((mels.size(0), len_diff, self.hp.num_mels), 0, dtype=torch.float32)
             mels = torch.cat((mels, pad.to(mels.device)), dim=1)
 
-        # Group all partials together so that we can batch them easily
-        partials = [
-            mel[i * frame_step: i * frame_step + self.hp.ve_partial_frames]
-            for mel, n_partial in zip(mels, n_partials) for i in range(n_partial)
-        ]
-        assert all(partials[0].shape == partial.shape for partial in partials)
-        partials = torch.stack(partials)
+        # All the windows of every utterance, as a strided view of the mels (B, W, P, M): nothing is copied
+        windows = mels.unfold(1, self.hp.ve_partial_frames, frame_step).transpose(2, 3)
 
-        # Forward the partials
-        n_chunks = int(np.ceil(len(partials) / (batch_size or len(partials))))
-        partial_embeds = torch.cat([self(batch) for batch in partials.chunk(n_chunks)], dim=0).cpu()
+        # The partials are the first n_partials windows of every utterance, in order; each batch of partials
+        # is gathered from the view when it is forwarded, so only one batch of (overlapping) windows is copied
+        n_partials = torch.tensor(n_partials, device=mels.device)
+        utt_idxs = torch.repeat_interleave(torch.arange(len(n_partials), device=mels.device), n_partials)
+        win_idxs = torch.arange(len(utt_idxs), device=mels.device) - (torch.cumsum(n_partials, 0) - n_partials)[utt_idxs]
 
-        # Reduce the partial embeds into full embeds and L2-normalize them
-        slices = np.concatenate(([0], np.cumsum(n_partials)))
-        raw_embeds = [torch.mean(partial_embeds[start:end], dim=0) for start, end in zip(slices[:-1], slices[1:])]
-        raw_embeds = torch.stack(raw_embeds)
+        # Forward the partials
+        batch_size = batch_size or len(utt_idxs)
+        partial_embeds = torch.cat([
+            self(windows[utt_idxs[i:i + batch_size], win_idxs[i:i + batch_size]])
+            for i in range(0, len(utt_idxs), batch_size)
+        ], dim=0)
+
+        # Reduce the partial embeds into full embeds (segment means) and L2-normalize them
+        raw_embeds = torch.zeros(len(n_partials), partial_embeds.size(1), device=partial_embeds.device)
+        raw_embeds = raw_embeds.index_add_(0, utt_idxs, partial_embeds) / n_partials.unsqueeze(1)
         embeds = raw_embeds / torch.linalg.norm(raw_embeds, dim=1, keepdim=True)
 
-        return embeds
+        return embeds.cpu()
 
     @staticmethod
     def utt_to_spk_embed(utt_embeds: np.ndarray):
@@ -245,30 +250,34 @@ class VoiceEncoder(nn.Module):
 
     def embeds_from_wavs(
         self,
-        wavs: List[np.ndarray],
+        wavs: Union[Tensor, List[np.ndarray]],
         sample_rate,
         as_spk=False,
         batch_size=32,
         trim_top_db: Optional[float]=20,
+        wav_lens=None,
         **kwargs
     ):
         """
-        Wrapper around embeds_from_mels
+        Wrapper around embeds_from_mels. The wavs are resampled, trimmed and turned into mels as a batch, on the
+        device of the model (see `MelFrontEnd`).
 
+        :param wavs: either a list of wavs, or a padded batch of wavs as a (B, T) tensor
+        :param wav_lens: if passing wavs as a tensor, individual wav lengths (by default all of T)
         :param trim_top_db: this argument was only added for the sake of compatibility with metavoice's implementation
         """
-        if sample_rate != self.hp.sample_rate:
-            wavs = [
-                librosa.resample(wav, orig_sr=sample_rate, target_sr=self.hp.sample_rate, res_type="kaiser_fast")
-                for wav in wavs
-            ]
-
-        if trim_top_db:
-            wavs = [librosa.effects.trim(wav, top_db=trim_top_db)[0] for wav in wavs]
+        if isinstance(wavs, List):
+            wav_lens = torch.tensor([len(wav) for wav in wavs])
+            wavs = pack([torch.as_tensor(np.asarray(wav)) for wav in wavs])
+        elif wav_lens is None:
+            wav_lens = torch.full((wavs.size(0),), wavs.size(1))
+        wav_lens = torch.as_tensor(wav_lens)
 
         if "rate" not in kwargs:
             kwargs["rate"] = 1.3  # Resemble's default value.
 
-        mels = [melspectrogram(w, self.hp).T for w in wavs]
+        mels, mel_lens = self.front_end(
+            wavs.to(self.device), wav_lens.to(self.device), sample_rate, trim_top_db=trim_top_db,
+        )
 
-        return self.embeds_from_mels(mels, as_spk=as_spk, batch_size=batch_size, **kwargs)
+        return self.embeds_from_mels(mels, mel_lens, as_spk=as_spk, batch_size=batch_size, **kwargs)
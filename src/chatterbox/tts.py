@@ -1,15 +1,25 @@
+import hashlib
+import logging
+import queue
+import re
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass
 from pathlib import Path
+from typing import List, Optional
 
 import librosa
 import torch
 import perth
 import torch.nn.functional as F
 from huggingface_hub import hf_hub_download
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
 
 from .models.t3 import T3
-from .models.s3tokenizer import S3_SR, drop_invalid_tokens
+from .models.s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, drop_invalid_tokens
 from .models.s3gen import S3GEN_SR, S3Gen
+from .models.s3gen.s3gen import get_resampler
 from .models.tokenizers import EnTokenizer
 from .models.voice_encoder import VoiceEncoder
 from .models.t3.modules.cond_enc import T3Cond
@@ -17,6 +27,8 @@ from .models.t3.modules.cond_enc import T3Cond
 
 REPO_ID = "ResembleAI/chatterbox"
 
+logger = logging.getLogger(__name__)
+
 
 def punc_norm(text: str) -> str:
     """
@@ -60,6 +72,50 @@ def punc_norm(text: str) -> str:
     return text
 
 
+def split_sentences(text: str, max_chars=300) -> List[str]:
+    """
+    Split long-form text into segments at sentence boundaries, merging consecutive sentences as long as
+    a segment stays within `max_chars`. Sentences longer than `max_chars` are split at commas, then spaces.
+    """
+    def split_long(piece, seps=(", ", " ")):
+        if len(piece) <= max_chars or not seps:
+            return [piece]
+        parts, cur = [], ""
+        for word in piece.split(seps[0]):
+            cand = f"{cur}{seps[0]}{word}" if cur else word
+            if cur and len(cand) > max_chars:
+                parts.append(cur)
+                cand = word
+            cur = cand
+        parts.append(cur)
+        return [q for p in parts for q in split_long(p, seps[1:])]
+
+    sentences = re.split(r"(?<=[.!?…])\s+", " ".join(text.split()))
+    segments, cur = [], ""
+    for sentence in sentences:
+        for piece in split_long(sentence):
+            if cur and len(cur) + 1 + len(piece) > max_chars:
+                segments.append(cur)
+                cur = piece
+            else:
+                cur = f"{cur} {piece}" if cur else piece
+    if cur:
+        segments.append(cur)
+    return segments
+
+
+def crossfade_concat(wavs: List[torch.Tensor], n_fade: int) -> torch.Tensor:
+    "Concatenate (1, T) waveforms along time, with a linear cross-fade of `n_fade` samples at each boundary."
+    pieces = [wavs[0]]
+    for wav in wavs[1:]:
+        prev = pieces.pop()
+        n = min(n_fade, prev.size(1), wav.size(1))
+        fade_in = torch.linspace(0, 1, n, device=wav.device)
+        overlap = prev[:, prev.size(1) - n:] * (1 - fade_in) + wav[:, :n] * fade_in
+        pieces += [prev[:, :prev.size(1) - n], overlap, wav[:, n:]]
+    return torch.cat(pieces, dim=1)
+
+
 @dataclass
 class Conditionals:
     """
@@ -87,6 +143,12 @@ class Conditionals:
                 self.gen[k] = v.to(device=device)
         return self
 
+    def clone(self) -> 'Conditionals':
+        "A copy with its own `T3Cond`, gen dict and tensors, which shares nothing with this one."
+        clone_value = lambda v: v.clone() if torch.is_tensor(v) else v
+        t3 = T3Cond(**{k: clone_value(v) for k, v in self.t3.__dict__.items()})
+        return Conditionals(t3, {k: clone_value(v) for k, v in self.gen.items()})
+
     def save(self, fpath: Path):
         arg_dict = dict(
             t3=self.t3.__dict__,
@@ -100,6 +162,83 @@ class Conditionals:
         return cls(T3Cond(**kwargs['t3']), kwargs['gen'])
 
 
+class ConditionalsCache:
+    """
+    Size-bounded LRU cache of `Conditionals`, keyed by the content hash of the reference audio file, so
+    repeated requests with the same clip skip the whole conditioning front end. `hits` and `misses` count
+    the lookups.
+    """
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(wav_fpath) -> str:
+        h = hashlib.sha256()
+        with open(wav_fpath, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    def get(self, key) -> Optional[Conditionals]:
+        conds = self._entries.get(key)
+        if conds is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return conds
+
+    def put(self, key, conds: Conditionals):
+        self._entries[key] = conds
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def load_s3gen_for_inference(s3gen_ckpt: Path, cache_dir: Optional[Path] = None) -> S3Gen:
+    """
+    Load S3Gen from `s3gen_ckpt`, with the weight norm of its vocoder folded (see `S3Token2Wav.fold_weight_norm`).
+
+    With a `cache_dir`, the folded state dict is cached there as "s3gen_inference.safetensors", tagged with
+    the size and mtime of `s3gen_ckpt`, and only reused for the same checkpoint. Failing to write the cache
+    (e.g. a read-only directory) only logs a warning: the folded weights are in memory either way.
+    """
+    s3gen = S3Gen()
+    st = s3gen_ckpt.stat()
+    source = {"source_size": str(st.st_size), "source_mtime_ns": str(st.st_mtime_ns)}
+    cache_fpath = None if cache_dir is None else Path(cache_dir) / "s3gen_inference.safetensors"
+
+    if cache_fpath is not None and cache_fpath.exists():
+        with safe_open(str(cache_fpath), framework="pt") as f:
+            metadata = f.metadata() or {}
+        if all(metadata.get(k) == v for k, v in source.items()):
+            s3gen.fold_weight_norm()  # the cached state dict has folded weights
+            s3gen.load_state_dict(load_file(cache_fpath))
+            return s3gen
+
+    s3gen.load_state_dict(
+        torch.load(s3gen_ckpt)
+    )
+    s3gen.fold_weight_norm()
+    if cache_fpath is not None:
+        try:
+            cache_fpath.parent.mkdir(parents=True, exist_ok=True)
+            state_dict = {k: v.contiguous() for k, v in s3gen.state_dict().items()}
+            save_file(state_dict, str(cache_fpath), metadata=source)
+        except OSError as e:
+            logger.warning(f"could not write the S3Gen inference cache {cache_fpath}: {e}")
+    return s3gen
+
+
 class ChatterboxTTS:
     ENC_COND_LEN = 6 * S3_SR
     DEC_COND_LEN = 10 * S3GEN_SR
@@ -112,6 +251,8 @@ class ChatterboxTTS:
         tokenizer: EnTokenizer,
         device: str,
         conds: Conditionals = None,
+        conds_cache_size: int = 32,
+        share_ref_resample: bool = False,
     ):
         self.sr = S3GEN_SR  # sample rate of synthesized audio
         self.t3 = t3
@@ -120,10 +261,34 @@ class ChatterboxTTS:
         self.tokenizer = tokenizer
         self.device = device
         self.conds = conds
+        self.conds_cache = ConditionalsCache(max_entries=conds_cache_size)
+        self.share_ref_resample = share_ref_resample
         self.watermarker = perth.PerthImplicitWatermarker()
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'ChatterboxTTS':
+    def from_local(
+        cls, ckpt_dir, device, estimator_backend="torch", compile_vocoder=False, cache_dir=None, conds_cache_size=32,
+        prefix_cache_size=8, share_ref_resample=False,
+    ) -> 'ChatterboxTTS':
+        """
+        `estimator_backend` selects what runs the flow-matching estimator of S3Gen: "torch", or "onnx" for
+        onnxruntime on CPU, exported from the loaded weights.
+
+        The vocoder is prepared for inference (see `S3Token2Wav.prepare_for_inference`). `compile_vocoder`
+        also compiles it with `torch.compile`.
+
+        `cache_dir` is an optional writable directory for derived files: the folded S3Gen weights
+        (see `load_s3gen_for_inference`) and the exported onnx estimator. Nothing is written to `ckpt_dir`.
+
+        `conds_cache_size` is the number of reference clips whose `Conditionals` are kept (0 disables the cache).
+        `prefix_cache_size` is the number of voices whose T3 conditioning prefix KV cache is kept (0 disables it),
+        see `T3.get_cond_prefix_cache` for its memory cost.
+
+        `share_ref_resample` resamples the reference clip to 16kHz once, with S3Gen's resampler, for T3, the voice
+        encoder and S3Gen, instead of with librosa for T3 and the voice encoder and again in S3Gen. The S3Gen
+        conditionals are the same either way, but the T3 conditionals change slightly (the two resamplers differ
+        by up to ~3e-2), so it is off by default.
+        """
         ckpt_dir = Path(ckpt_dir)
 
         ve = VoiceEncoder()
@@ -132,18 +297,20 @@ class ChatterboxTTS:
         )
         ve.to(device).eval()
 
-        t3 = T3()
+        t3 = T3(prefix_cache_size=prefix_cache_size)
         t3_state = torch.load(ckpt_dir / "t3_cfg.pt")
         if "model" in t3_state.keys():
             t3_state = t3_state["model"][0]
         t3.load_state_dict(t3_state)
         t3.to(device).eval()
 
-        s3gen = S3Gen()
-        s3gen.load_state_dict(
-            torch.load(ckpt_dir / "s3gen.pt")
-        )
+        s3gen = load_s3gen_for_inference(ckpt_dir / "s3gen.pt", cache_dir=cache_dir)
         s3gen.to(device).eval()
+        s3gen.prepare_for_inference(compile=compile_vocoder)
+        if estimator_backend != "torch":
+            assert torch.device(device).type == "cpu", "the onnx estimator backend only runs on CPU"
+            onnx_path = None if cache_dir is None else Path(cache_dir) / "s3gen_estimator.onnx"
+            s3gen.set_estimator_backend(estimator_backend, onnx_path=onnx_path)
 
         tokenizer = EnTokenizer(
             str(ckpt_dir / "tokenizer.json")
@@ -153,23 +320,53 @@ class ChatterboxTTS:
         if (builtin_voice := ckpt_dir / "conds.pt").exists():
             conds = Conditionals.load(builtin_voice).to(device)
 
-        return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
+        return cls(
+            t3, s3gen, ve, tokenizer, device, conds=conds, conds_cache_size=conds_cache_size,
+            share_ref_resample=share_ref_resample,
+        )
 
     @classmethod
-    def from_pretrained(cls, device) -> 'ChatterboxTTS':
+    def from_pretrained(
+        cls, device, estimator_backend="torch", compile_vocoder=False, cache_dir=None, conds_cache_size=32,
+        prefix_cache_size=8, share_ref_resample=False,
+    ) -> 'ChatterboxTTS':
         for fpath in ["ve.pt", "t3_cfg.pt", "s3gen.pt", "tokenizer.json", "conds.pt"]:
             local_path = hf_hub_download(repo_id=REPO_ID, filename=fpath)
 
-        return cls.from_local(Path(local_path).parent, device)
+        return cls.from_local(
+            Path(local_path).parent, device, estimator_backend=estimator_backend, compile_vocoder=compile_vocoder,
+            cache_dir=cache_dir, conds_cache_size=conds_cache_size, prefix_cache_size=prefix_cache_size,
+            share_ref_resample=share_ref_resample,
+        )
 
     def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
+        cache_key = None
+        if self.conds_cache.max_entries > 0:
+            cache_key = self.conds_cache.key(wav_fpath)
+            cached = self.conds_cache.get(cache_key)
+            if cached is not None:
+                # a copy, so that nothing done to `self.conds` leaks into the cache
+                self.conds = cached.clone()
+                self.conds.t3.emotion_adv = exaggeration * torch.ones(1, 1, 1, device=self.device)
+                return
+
         ## Load reference wav
         s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
 
-        ref_16k_wav = librosa.resample(s3gen_ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
+        ref_wav_16 = None
+        if self.share_ref_resample:
+            # a single 16kHz version of the reference for T3, the voice encoder and S3Gen, with the resampler
+            # S3Gen itself would use, so that sharing it leaves the S3Gen conditionals unchanged
+            ref_16k_wav = torch.from_numpy(s3gen_ref_wav).to(self.device)[None]
+            ref_16k_wav = get_resampler(S3GEN_SR, S3_SR, self.device)(ref_16k_wav)[0].cpu().numpy()
+            # (past its crop, the resampler would also see the samples after it, so S3Gen resamples the crop)
+            if len(s3gen_ref_wav) <= self.DEC_COND_LEN:
+                ref_wav_16 = ref_16k_wav
+        else:
+            ref_16k_wav = librosa.resample(s3gen_ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
 
         s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        s3gen_ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+        s3gen_ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device, ref_wav_16=ref_wav_16)
 
         # Speech cond prompt tokens
         if plen := self.t3.hp.speech_cond_prompt_len:
@@ -187,15 +384,16 @@ class ChatterboxTTS:
             emotion_adv=exaggeration * torch.ones(1, 1, 1),
         ).to(device=self.device)
         self.conds = Conditionals(t3_cond, s3gen_ref_dict)
+        if cache_key is not None:
+            self.conds_cache.put(cache_key, self.conds.clone())
 
-    def generate(
-        self,
-        text,
-        audio_prompt_path=None,
-        exaggeration=0.5,
-        cfg_weight=0.5,
-        temperature=0.8,
-    ):
+    def _prepare_generate(self, text, audio_prompt_path, exaggeration):
+        """Update the conditionals if needed, and return the CFG-doubled text tokens for `text`."""
+        self._update_conditionals(audio_prompt_path, exaggeration)
+        text_tokens = self._tokenize(text)
+        return torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
+
+    def _update_conditionals(self, audio_prompt_path, exaggeration):
         if audio_prompt_path:
             self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
         else:
@@ -210,15 +408,33 @@ class ChatterboxTTS:
                 emotion_adv=exaggeration * torch.ones(1, 1, 1),
             ).to(device=self.device)
 
-        # Norm and tokenize text
+    def _tokenize(self, text):
+        """Normalize and tokenize `text`, including the start / stop text tokens; shape (1, T)."""
         text = punc_norm(text)
         text_tokens = self.tokenizer.text_to_tokens(text).to(self.device)
-        text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
 
         sot = self.t3.hp.start_text_token
         eot = self.t3.hp.stop_text_token
         text_tokens = F.pad(text_tokens, (1, 0), value=sot)
         text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        return text_tokens
+
+    def generate(
+        self,
+        text,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        n_timesteps=10,
+        solver=None,
+        cfg_steps=None,
+    ):
+        """
+        `n_timesteps`, `solver` and `cfg_steps` set the flow-matching ODE solver of S3Gen, see
+        `S3Token2Mel.forward`. E.g. 5 steps of "dpm" halve the estimator calls of the default 10 "euler" steps.
+        """
+        text_tokens = self._prepare_generate(text, audio_prompt_path, exaggeration)
 
         with torch.inference_mode():
             speech_tokens = self.t3.inference(
@@ -238,7 +454,158 @@ class ChatterboxTTS:
             wav, _ = self.s3gen.inference(
                 speech_tokens=speech_tokens,
                 ref_dict=self.conds.gen,
+                n_timesteps=n_timesteps,
+                solver=solver,
+                cfg_steps=cfg_steps,
             )
             wav = wav.squeeze(0).detach().cpu().numpy()
             watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
         return torch.from_numpy(watermarked_wav).unsqueeze(0)
+
+    def generate_stream(
+        self,
+        text,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        chunk_size=25,
+        eos_check_interval=5,
+    ):
+        """
+        Streaming version of `generate`: yields watermarked audio chunks of shape (1, T) while T3 is still
+        sampling. Every `chunk_size` new speech tokens go through S3Gen, which only encodes the new tokens
+        (see `S3Token2Wav.flow_stream_inference`), and consecutive chunks are cross-faded. A smaller
+        `chunk_size` lowers the latency of the first chunk, at the cost of more S3Gen calls in total. T3 hands
+        over its tokens every `eos_check_interval` steps.
+
+        NOTE: the audio is not the same as that of `generate` for the same speech tokens. The S3Gen encoder of
+        `generate` attends over all the tokens, while here the tokens of a chunk only see those up to its end
+        (see `CausalMaskedDiffWithXvec.inference_chunk`). The CFM decoder also runs over all the frames so far
+        for every chunk, so the S3Gen cost per chunk grows with the length of the utterance.
+        """
+        text_tokens = self._prepare_generate(text, audio_prompt_path, exaggeration)
+        # the flow holds back the last `pre_lookahead_len` tokens until the tokens they look ahead at arrive
+        lookahead = self.s3gen.flow.pre_lookahead_len
+
+        speech_tokens = []  # tokens not passed to S3Gen yet
+        n_tokens = 0
+        n_chunks = 0
+        with torch.inference_mode():
+            flow_state = self.s3gen.flow_stream_init(ref_dict=self.conds.gen)
+            hift_session = self.s3gen.hift_stream_session()
+            for tokens in self.t3.inference_stream(
+                t3_cond=self.conds.t3,
+                text_tokens=text_tokens,
+                max_new_tokens=self.t3.hp.max_speech_tokens,
+                temperature=temperature,
+                cfg_weight=cfg_weight,
+                eos_check_interval=eos_check_interval,
+            ):
+                # Extract only the conditional batch, and drop SOS/EOS.
+                tokens = tokens[0]
+                tokens = tokens[tokens < SPEECH_VOCAB_SIZE]
+                speech_tokens.append(tokens)
+                n_tokens += len(tokens)
+                # the first chunk also waits for the tokens its last tokens look ahead at
+                if n_tokens < chunk_size + (lookahead if n_chunks == 0 else 0):
+                    continue
+
+                wav, flow_state = self._synthesize_chunk(speech_tokens, flow_state, hift_session, finalize=False)
+                speech_tokens, n_tokens = [], 0
+                n_chunks += 1
+                yield wav
+
+            if n_tokens > 0 or n_chunks > 0:
+                # flush the held back tokens and audio
+                wav, _ = self._synthesize_chunk(speech_tokens, flow_state, hift_session, finalize=True)
+                yield wav
+
+    def _synthesize_chunk(self, speech_tokens, flow_state, hift_session, finalize):
+        speech_tokens = torch.cat(speech_tokens) if speech_tokens else torch.zeros(0, dtype=torch.long)
+        output_mels, flow_state = self.s3gen.flow_stream_inference(speech_tokens, flow_state, finalize=finalize)
+
+        wav = hift_session.push(output_mels, finalize=finalize)
+        wav = wav.squeeze(0).detach().cpu().numpy()
+        # (the vocoder holds back the audio of its first frames until it has enough of them)
+        watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr) if len(wav) > 0 else wav
+        return torch.from_numpy(watermarked_wav).unsqueeze(0), flow_state
+
+    def generate_long(
+        self,
+        text,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        max_chars=300,
+        batch_size=4,
+        crossfade_ms=50,
+    ):
+        """
+        Long-form synthesis, e.g. for whole documents. The text is split into segments at sentence boundaries
+        (see `split_sentences`), which T3 decodes in batches of `batch_size` on a producer thread, while this
+        thread runs S3Gen on the segments that are already decoded. Segments are stitched with a cross-fade
+        of `crossfade_ms`, and the result is watermarked once.
+        """
+        self._update_conditionals(audio_prompt_path, exaggeration)
+        segments = split_sentences(text, max_chars=max_chars)
+        text_tokens = [self._tokenize(segment)[0] for segment in segments]
+
+        token_queue = queue.Queue(maxsize=2 * batch_size)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    token_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def produce():
+            try:
+                for i in range(0, len(text_tokens), batch_size):
+                    if stop.is_set():
+                        return
+                    batch = self.t3.inference_batch(
+                        t3_cond=self.conds.t3,
+                        text_tokens=text_tokens[i:i + batch_size],
+                        max_new_tokens=self.t3.hp.max_speech_tokens,
+                        temperature=temperature,
+                        cfg_weight=cfg_weight,
+                    )
+                    for speech_tokens in batch:
+                        put(speech_tokens)
+                put(done)
+            except BaseException as e:
+                put(e)
+
+        producer = threading.Thread(target=produce, name="t3-producer", daemon=True)
+        producer.start()
+
+        wavs = []
+        try:
+            with torch.inference_mode():
+                while (item := token_queue.get()) is not done:
+                    if isinstance(item, BaseException):
+                        raise item
+                    speech_tokens = drop_invalid_tokens(item).to(self.device)
+                    if len(speech_tokens) == 0:
+                        continue
+                    wav, _ = self.s3gen.inference(
+                        speech_tokens=speech_tokens,
+                        ref_dict=self.conds.gen,
+                    )
+                    wavs.append(wav.cpu())
+        finally:
+            stop.set()
+            producer.join()
+
+        if not wavs:
+            return torch.zeros(1, 0)
+        wav = crossfade_concat(wavs, n_fade=int(self.sr * crossfade_ms / 1000))
+        wav = wav.squeeze(0).detach().numpy()
+        watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
+        return torch.from_numpy(watermarked_wav).unsqueeze(0)
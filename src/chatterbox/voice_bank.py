@@ -0,0 +1,100 @@
+import json
+from pathlib import Path
+from typing import Dict, Iterable, Tuple, Union
+
+import numpy as np
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from .tts import Conditionals
+from .models.t3.modules.cond_enc import T3Cond
+
+
+FORMAT_NAME = "chatterbox-voice-bank"
+FORMAT_VERSION = "1"
+
+# derived from `cond_prompt_speech_tokens` by T3 itself, and large, so never stored
+SKIPPED_T3_FIELDS = {"cond_prompt_speech_emb"}
+
+
+def _pack(prefix: str, values: dict, tensors: dict, skip=()):
+    "Move the tensors of `values` into `tensors` under `prefix`, and return an index entry for the rest."
+    entry = {"tensors": [], "values": {}}
+    for k, v in values.items():
+        if k in skip:
+            continue
+        if isinstance(v, np.ndarray):
+            v = torch.from_numpy(v)
+        if torch.is_tensor(v):
+            tensors[f"{prefix}/{k}"] = v.detach().cpu().contiguous()
+            entry["tensors"].append(k)
+        else:
+            entry["values"][k] = v  # None / python scalars
+    return entry
+
+
+class VoiceBank:
+    """
+    Many voices' `Conditionals` packed into a single safetensors file, with a JSON index of the voices in the
+    file metadata. The file is memory-mapped, and only the tensors of the requested voice are read, so a
+    worker can serve any voice of a large bank without unpickling anything or keeping the bank in RAM.
+
+    Tensors are stored as "{voice_id}/t3/{field}" and "{voice_id}/gen/{field}".
+
+    Usage:
+        VoiceBank.write("voices.safetensors", {"alice": conds_a, "bob": conds_b})
+        bank = VoiceBank("voices.safetensors")
+        tts.conds = bank.get("alice", device=tts.device)
+    """
+
+    def __init__(self, fpath: Union[str, Path]):
+        self.fpath = Path(fpath)
+        self._file = safe_open(str(self.fpath), framework="pt", device="cpu")
+        metadata = self._file.metadata() or {}
+        assert metadata.get("format") == FORMAT_NAME, f"{fpath} is not a voice bank"
+        assert metadata.get("version") == FORMAT_VERSION, f"unsupported voice bank version {metadata.get('version')}"
+        self.index: Dict[str, dict] = json.loads(metadata["voices"])
+
+    @staticmethod
+    def write(fpath: Union[str, Path], voices: Union[Dict[str, Conditionals], Iterable[Tuple[str, Conditionals]]]):
+        "Write a new bank with the given voices, as a dict or (voice_id, conditionals) pairs."
+        if isinstance(voices, dict):
+            voices = voices.items()
+
+        tensors = {}
+        index = {}
+        for voice_id, conds in voices:
+            assert voice_id not in index, f"duplicate voice id {voice_id!r}"
+            index[voice_id] = {
+                "t3": _pack(f"{voice_id}/t3", conds.t3.__dict__, tensors, skip=SKIPPED_T3_FIELDS),
+                "gen": _pack(f"{voice_id}/gen", conds.gen, tensors),
+            }
+
+        metadata = {"format": FORMAT_NAME, "version": FORMAT_VERSION, "voices": json.dumps(index)}
+        save_file(tensors, str(fpath), metadata=metadata)
+
+    def _unpack(self, prefix: str, entry: dict) -> dict:
+        values = dict(entry["values"])
+        for k in entry["tensors"]:
+            values[k] = self._file.get_tensor(f"{prefix}/{k}")
+        return values
+
+    def get(self, voice_id: str, device="cpu") -> Conditionals:
+        "Read one voice from the bank, and move it to `device`."
+        if voice_id not in self.index:
+            raise KeyError(f"voice {voice_id!r} not in {self.fpath}")
+        entry = self.index[voice_id]
+        t3_cond = T3Cond(**self._unpack(f"{voice_id}/t3", entry["t3"]))
+        gen = self._unpack(f"{voice_id}/gen", entry["gen"])
+        return Conditionals(t3_cond, gen).to(device)
+
+    @property
+    def voice_ids(self):
+        return list(self.index)
+
+    def __contains__(self, voice_id):
+        return voice_id in self.index
+
+    def __len__(self):
+        return len(self.index)
@@ -0,0 +1,45 @@
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+
+
+# the python package is not installed, import it from the source tree
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+
+@pytest.fixture(autouse=True)
+def seed():
+    torch.manual_seed(0)
+
+
+@pytest.fixture(scope="module")
+def t3():
+    "A tiny random T3, without the perceiver resampler."
+    from chatterbox.models.t3 import T3
+    from chatterbox.models.t3.llama_configs import LLAMA_CONFIGS, LLAMA_520M_CONFIG_DICT
+    from chatterbox.models.t3.modules.t3_config import T3Config
+
+    LLAMA_CONFIGS["Llama_test"] = dict(
+        LLAMA_520M_CONFIG_DICT, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4,
+        num_key_value_heads=4, head_dim=16, torch_dtype="float32",
+    )
+    torch.manual_seed(0)
+    hp = T3Config()
+    hp.llama_config_name = "Llama_test"
+    hp.max_text_tokens = 64
+    hp.max_speech_tokens = 96
+    hp.use_perceiver_resampler = False
+    return T3(hp).eval()
+
+
+@pytest.fixture(scope="session")
+def s3gen():
+    "A random S3Gen, with the weight norm of its vocoder folded."
+    from chatterbox.models.s3gen import S3Gen
+
+    torch.manual_seed(0)
+    s3gen = S3Gen().eval()
+    s3gen.fold_weight_norm()
+    return s3gen
@@ -0,0 +1,34 @@
+import torch
+
+from chatterbox.tts import Conditionals, ConditionalsCache
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+
+
+def make_conds():
+    t3 = T3Cond(
+        speaker_emb=torch.randn(1, 256),
+        cond_prompt_speech_tokens=torch.randint(0, 6561, (1, 150)),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    )
+    gen = dict(prompt_token=torch.randint(0, 6561, (1, 50)), prompt_feat=torch.randn(1, 100, 80), prompt_feat_len=None)
+    return Conditionals(t3, gen)
+
+
+def test_cached_conditionals_are_isolated():
+    conds = make_conds()
+    cache = ConditionalsCache()
+    cache.put("voice", conds.clone())
+    cached = cache.get("voice")
+    assert cached.t3 is not conds.t3 and cached.gen is not conds.gen
+
+    expected = {k: v.clone() for k, v in cached.t3.__dict__.items() if torch.is_tensor(v)}
+    expected_feat = cached.gen["prompt_feat"].clone()
+    # what `T3.prepare_conditioning` and `_update_conditionals` do to the live conditionals
+    conds.t3.cond_prompt_speech_emb = torch.randn(1, 150, 1024)
+    conds.t3.emotion_adv.fill_(1.0)
+    conds.t3.speaker_emb.zero_()
+    conds.gen["prompt_feat"].zero_()
+
+    assert cached.t3.cond_prompt_speech_emb is None
+    assert all(torch.equal(getattr(cached.t3, k), v) for k, v in expected.items())
+    assert torch.equal(cached.gen["prompt_feat"], expected_feat)
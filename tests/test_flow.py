@@ -0,0 +1,38 @@
+import pytest
+import torch
+
+from chatterbox.models.s3gen.s3gen import collate_ref_dicts
+
+
+def make_ref_dict(n_prompt_tokens):
+    "A random ref dict (see `S3Token2Mel.embed_ref`) with a prompt of `n_prompt_tokens` tokens."
+    return dict(
+        prompt_token=torch.randint(0, 6561, (1, n_prompt_tokens)),
+        prompt_token_len=torch.LongTensor([n_prompt_tokens]),
+        prompt_feat=torch.randn(1, 2 * n_prompt_tokens, 80),
+        prompt_feat_len=None,
+        embedding=torch.randn(1, 192),
+    )
+
+
+@pytest.mark.parametrize("finalize", [True, False])
+def test_batched_inference_matches_per_utterance(s3gen, finalize):
+    ref_dicts = [make_ref_dict(n) for n in (25, 9, 17)]
+    speech_tokens = [torch.randint(0, 6561, (n,)) for n in (30, 41, 12)]
+
+    batch = collate_ref_dicts(ref_dicts)
+    token_lens = torch.LongTensor([len(t) for t in speech_tokens])
+    tokens = torch.nn.utils.rnn.pad_sequence(speech_tokens, batch_first=True)
+    mels, mel_lens = s3gen.flow.inference(
+        token=tokens, token_len=token_lens, finalize=finalize, n_timesteps=4, **batch,
+    )
+
+    for i, (ref_dict, token) in enumerate(zip(ref_dicts, speech_tokens)):
+        mel, mel_len = s3gen.flow.inference(
+            token=token[None], token_len=token_lens[i:i + 1], finalize=finalize, n_timesteps=4, **ref_dict,
+        )
+        assert int(mel_lens[i]) == int(mel_len[0])
+        assert (mels[i, :, :int(mel_lens[i])] - mel[0, :, :int(mel_len[0])]).abs().max() < 1e-5
+        # the padding of the batch is zeroed
+        assert not mels[i, :, int(mel_lens[i]):].any()
+
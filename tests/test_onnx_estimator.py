@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+import torch
+
+pytest.importorskip("onnxruntime")
+
+from chatterbox.models.s3gen.decoder import ConditionalDecoder
+from chatterbox.models.s3gen.flow_matching import ConditionalCFM, CFM_PARAMS
+from chatterbox.models.s3gen.onnx_estimator import OnnxEstimator, check_onnx_estimator, export_estimator_onnx
+
+
+def small_decoder():
+    return ConditionalDecoder(
+        in_channels=320, out_channels=80, channels=[32], attention_head_dim=16, n_blocks=1, num_mid_blocks=1,
+        num_heads=2,
+    ).eval()
+
+
+@pytest.fixture(scope="module")
+def exported(tmp_path_factory):
+    torch.manual_seed(0)
+    estimator = small_decoder()
+    fpath = tmp_path_factory.mktemp("onnx") / "estimator.onnx"
+    export_estimator_onnx(estimator, fpath)
+    return estimator, OnnxEstimator(fpath)
+
+
+# batch sizes 2 and 4 are the CFG-doubled batches of 1 and 2 utterances
+@pytest.mark.parametrize("batch_size", [1, 2, 3, 4])
+@pytest.mark.parametrize("seq_len", [17, 64, 203])
+def test_onnx_matches_torch(exported, batch_size, seq_len):
+    estimator, onnx_estimator = exported
+    assert check_onnx_estimator(estimator, onnx_estimator, batch_size=batch_size, seq_len=seq_len) < 1e-4
+
+
+def test_onnx_output_not_shared(exported):
+    _, onnx_estimator = exported
+    inputs = [torch.randn(2, 80, 32), torch.ones(2, 1, 32), torch.randn(2, 80, 32), torch.rand(2),
+              torch.randn(2, 80), torch.randn(2, 80, 32)]
+    first = onnx_estimator(*inputs)
+    expected = first.clone()
+    onnx_estimator(*[torch.randn_like(i) for i in inputs])
+    assert torch.equal(first, expected)
+
+
+def test_onnx_concurrent_calls(exported):
+    _, onnx_estimator = exported
+    inputs = [[torch.randn(2, 80, 32), torch.ones(2, 1, 32), torch.randn(2, 80, 32), torch.rand(2),
+               torch.randn(2, 80), torch.randn(2, 80, 32)] for _ in range(4)]
+    expected = [onnx_estimator(*i) for i in inputs]
+    results = [None] * len(inputs)
+
+    def run(n):
+        for _ in range(10):
+            results[n] = onnx_estimator(*inputs[n])
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(len(inputs))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert all(torch.equal(r, e) for r, e in zip(results, expected))
+
+
+def test_onnx_cache_reexported_for_other_weights(tmp_path):
+    cfm = ConditionalCFM(in_channels=240, cfm_params=CFM_PARAMS, spk_emb_dim=80, estimator=small_decoder())
+    onnx_path = tmp_path / "estimator.onnx"
+    cfm.set_estimator_backend("onnx", onnx_path=onnx_path)
+    first_fingerprint = cfm.estimator_backend.fingerprint
+    assert first_fingerprint is not None
+
+    # same weights: the cached graph is reused
+    mtime = onnx_path.stat().st_mtime_ns
+    cfm.set_estimator_backend("onnx", onnx_path=onnx_path)
+    assert onnx_path.stat().st_mtime_ns == mtime
+
+    # other weights: the stale graph is replaced
+    with torch.no_grad():
+        for p in cfm.estimator.parameters():
+            p.add_(0.01)
+    cfm.set_estimator_backend("onnx", onnx_path=onnx_path)
+    assert cfm.estimator_backend.fingerprint != first_fingerprint
+    assert check_onnx_estimator(cfm.estimator, cfm.estimator_backend) < 1e-4
+
+
+def test_onnx_without_path(tmp_path):
+    cfm = ConditionalCFM(in_channels=240, cfm_params=CFM_PARAMS, spk_emb_dim=80, estimator=small_decoder())
+    cfm.set_estimator_backend("onnx")
+    assert not cfm.estimator_backend.fpath.exists()
+    assert check_onnx_estimator(cfm.estimator, cfm.estimator_backend) < 1e-4
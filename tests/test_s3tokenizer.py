@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+from chatterbox.models.s3tokenizer import S3_SR, S3Tokenizer
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    torch.manual_seed(0)
+    return S3Tokenizer().eval()
+
+
+@pytest.fixture
+def wavs():
+    "16 kHz wavs of different lengths, not multiples of the token hop."
+    return [0.5 * torch.rand(n) - 0.25 for n in (S3_SR * 3 + 123, S3_SR + 7, S3_SR * 2 - 480)]
+
+
+def tokenize_each(tokenizer, wavs):
+    return [tokenizer.forward([wav]) for wav in wavs]
+
+
+def test_log_mel_spectrogram_batch_matches_per_wav(tokenizer, wavs):
+    wav_lens = torch.tensor([len(wav) for wav in wavs])
+    padded = torch.nn.utils.rnn.pad_sequence(wavs, batch_first=True)
+    mels, mel_lens = tokenizer.log_mel_spectrogram_batch(padded, wav_lens)
+
+    for mel, mel_len, wav in zip(mels, mel_lens, wavs):
+        single = tokenizer.log_mel_spectrogram(wav)
+        assert int(mel_len) == single.size(-1)
+        assert (mel[:, :int(mel_len)] - single).abs().max() < 1e-5
+        assert not mel[:, int(mel_len):].any()
+
+
+@pytest.mark.parametrize("as_tensor", [False, True])
+def test_batched_tokens_match_per_wav(tokenizer, wavs, as_tensor):
+    if as_tensor:
+        wav_lens = torch.tensor([len(wav) for wav in wavs])
+        padded = torch.nn.utils.rnn.pad_sequence(wavs, batch_first=True)
+        tokens, token_lens = tokenizer.forward(padded, wav_lens=wav_lens)
+    else:
+        tokens, token_lens = tokenizer.forward(wavs)
+
+    for i, (single_tokens, single_lens) in enumerate(tokenize_each(tokenizer, wavs)):
+        assert int(token_lens[i]) == int(single_lens[0])
+        assert torch.equal(tokens[i, :int(token_lens[i])], single_tokens[0, :int(single_lens[0])])
@@ -0,0 +1,133 @@
+import copy
+
+import pytest
+import torch
+from transformers import DynamicCache
+from transformers.generation.logits_process import RepetitionPenaltyLogitsProcessor, TopPLogitsWarper
+
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from chatterbox.models.t3.inference.static_decode import T3StaticDecoder
+
+
+def make_inputs(t3, n_text=12, seed=1):
+    g = torch.Generator().manual_seed(seed)
+    text = torch.randint(1, t3.hp.start_text_token, (n_text,), generator=g)
+    text = torch.cat([torch.tensor([t3.hp.start_text_token]), text, torch.tensor([t3.hp.stop_text_token])])
+    t3_cond = T3Cond(speaker_emb=torch.randn(1, t3.hp.speaker_embed_size, generator=g), emotion_adv=0.5 * torch.ones(1, 1, 1))
+    return t3_cond, torch.stack([text, text])  # CFG rows
+
+
+@torch.inference_mode()
+def reference_inference(t3, t3_cond, text_tokens, max_new_tokens, temperature, top_p, repetition_penalty, cfg_weight):
+    "The decode loop of `T3.inference` before the on-device sampler, with the HF logits processors."
+    speech_tokens = t3.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
+    embeds, _ = t3.prepare_input_embeds(t3_cond=t3_cond, text_tokens=text_tokens, speech_tokens=speech_tokens)
+    bos_token = torch.tensor([[t3.hp.start_speech_token]])
+    bos_embed = t3.speech_emb(bos_token) + t3.speech_pos_emb.get_fixed_embedding(0)
+    inputs_embeds = torch.cat([embeds, torch.cat([bos_embed, bos_embed])], dim=1)
+
+    generated_ids = bos_token.clone()
+    predicted = []
+    top_p_warper = TopPLogitsWarper(top_p=top_p)
+    repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty)
+
+    out = t3.tfmr(inputs_embeds=inputs_embeds, past_key_values=DynamicCache(), use_cache=True)
+    for i in range(max_new_tokens):
+        logits = t3.speech_head(out.last_hidden_state[:, -1])
+        logits = logits[0:1] + cfg_weight * (logits[0:1] - logits[1:2])
+        if temperature != 1.0:
+            logits = logits / temperature
+        logits = repetition_penalty_processor(generated_ids, logits)
+        logits = top_p_warper(None, logits)
+        next_token = torch.multinomial(torch.softmax(logits, dim=-1), num_samples=1)
+
+        predicted.append(next_token)
+        generated_ids = torch.cat([generated_ids, next_token], dim=1)
+        if next_token.view(-1) == t3.hp.stop_speech_token:
+            break
+
+        next_embed = t3.speech_emb(next_token) + t3.speech_pos_emb.get_fixed_embedding(i + 1)
+        out = t3.tfmr(inputs_embeds=torch.cat([next_embed, next_embed]), past_key_values=out.past_key_values, use_cache=True)
+    return torch.cat(predicted, dim=1)
+
+
+SAMPLING = {
+    "greedy": dict(temperature=1.0, top_p=1e-6, repetition_penalty=1.0, cfg_weight=0.0),
+    "top_p_repetition_cfg": dict(temperature=0.8, top_p=0.8, repetition_penalty=2.0, cfg_weight=0.5),
+}
+
+
+@pytest.mark.parametrize("sampling", SAMPLING)
+def test_inference_matches_reference(t3, sampling):
+    t3_cond, text_tokens = make_inputs(t3)
+    kwargs = SAMPLING[sampling]
+    torch.manual_seed(123)
+    expected = reference_inference(t3, t3_cond, text_tokens, max_new_tokens=40, **kwargs)
+    torch.manual_seed(123)
+    actual = t3.inference(t3_cond=t3_cond, text_tokens=text_tokens, max_new_tokens=40, **kwargs)
+    assert torch.equal(actual, expected)
+
+
+@pytest.mark.parametrize("eos_check_interval", [1, 4, 7])
+def test_inference_is_concatenated_stream(t3, eos_check_interval):
+    t3_cond, text_tokens = make_inputs(t3)
+    kwargs = dict(t3_cond=t3_cond, text_tokens=text_tokens, max_new_tokens=30, **SAMPLING["top_p_repetition_cfg"])
+    torch.manual_seed(7)
+    expected = t3.inference(**kwargs)
+    torch.manual_seed(7)
+    chunks = list(t3.inference_stream(eos_check_interval=eos_check_interval, **kwargs))
+    assert all(c.size(1) > 0 for c in chunks)
+    assert torch.equal(torch.cat(chunks, dim=1), expected)
+
+
+def test_static_cache_default_max_new_tokens(t3):
+    t3_cond, text_tokens = make_inputs(t3)
+    kwargs = dict(t3_cond=t3_cond, text_tokens=text_tokens, **SAMPLING["greedy"])
+    t3.static_decoder = T3StaticDecoder(t3, compile_mode=None)
+    try:
+        tokens = t3.inference(use_static_cache=True, **kwargs)
+    finally:
+        t3.static_decoder = None
+    # clamped to what fits in the static cache after the prompt
+    prompt_len = 1 + 1 + text_tokens.size(1) + 1  # speaker, emotion, text, BOS
+    assert 0 < tokens.size(1) <= t3.hp.max_speech_tokens - prompt_len
+    # the same tokens as the dynamic cache, up to where the static cache stops
+    expected = t3.inference(max_new_tokens=tokens.size(1), **kwargs)
+    assert torch.equal(tokens, expected)
+
+
+
+@pytest.fixture(scope="module")
+def t3_eos(t3):
+    """
+    The tiny T3 with larger transformer weights, so that the tokens depend on the prompt (and not mostly on the
+    previous token), and a larger EOS logit, so that requests stop at different steps.
+    """
+    t3 = copy.deepcopy(t3)
+    with torch.no_grad():
+        for p in t3.tfmr.layers.parameters():
+            if p.dim() == 2:
+                p.mul_(10)
+        t3.speech_head.weight[t3.hp.stop_speech_token].mul_(3)
+    return t3
+
+
+@pytest.mark.parametrize("eos_check_interval", [1, 5])
+def test_inference_batch_matches_per_request(t3_eos, eos_check_interval):
+    t3 = t3_eos
+    requests = [make_inputs(t3, n_text=n, seed=n) for n in (12, 3, 25, 7)]
+    kwargs = dict(max_new_tokens=40, **SAMPLING["greedy"])
+    expected = [t3.inference(t3_cond=t3_cond, text_tokens=text_tokens, **kwargs)[0] for t3_cond, text_tokens in requests]
+    # some requests stop early, at different steps, and some run to `max_new_tokens`
+    stopped = [len(e) for e in expected if e[-1] == t3.hp.stop_speech_token]
+    assert len(set(stopped)) > 1 and len(stopped) < len(expected)
+
+    actual = t3.inference_batch(
+        t3_cond=[t3_cond for t3_cond, _ in requests],
+        text_tokens=[text_tokens[0] for _, text_tokens in requests],
+        eos_check_interval=eos_check_interval,
+        **kwargs,
+    )
+    assert len(actual) == len(expected)
+    for a, e in zip(actual, expected):
+        assert torch.equal(a, e)
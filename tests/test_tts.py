@@ -0,0 +1,79 @@
+import librosa
+import numpy as np
+import perth
+import pytest
+import soundfile as sf
+import torch
+
+from chatterbox.tts import ChatterboxTTS
+from chatterbox.models.s3gen import S3GEN_SR
+from chatterbox.models.s3gen.s3gen import get_resampler
+from chatterbox.models.s3tokenizer import S3_SR
+from chatterbox.models.voice_encoder import VoiceEncoder
+
+
+def make_tts(t3, s3gen, **kwargs):
+    "A `ChatterboxTTS` of the tiny models, with a dummy watermarker (the perth one may not be available)."
+    t3.hp.speech_cond_prompt_len = 150
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(perth, "PerthImplicitWatermarker", perth.DummyWatermarker)
+        return ChatterboxTTS(t3, s3gen, VoiceEncoder().eval(), tokenizer=None, device="cpu", **kwargs)
+
+
+@pytest.fixture(scope="module", params=[False, True], ids=["librosa", "shared"])
+def tts(request, t3, s3gen):
+    return make_tts(t3, s3gen, conds_cache_size=0, share_ref_resample=request.param)
+
+
+def write_ref(fpath, seconds):
+    g = np.random.default_rng(seconds)
+    t = np.arange(seconds * S3GEN_SR) / S3GEN_SR
+    wav = 0.3 * np.sin(2 * np.pi * 180 * t) * np.sin(2 * np.pi * 2 * t) + 0.02 * g.standard_normal(t.size)
+    sf.write(fpath, wav.astype(np.float32), S3GEN_SR, subtype="FLOAT")
+    return fpath
+
+
+@pytest.mark.parametrize("seconds", [4, 12])  # shorter and longer than the S3Gen conditioning crop
+def test_prepare_conditionals(tts, tmp_path, seconds):
+    fpath = write_ref(tmp_path / "ref.wav", seconds)
+    tts.prepare_conditionals(fpath, exaggeration=0.7)
+
+    # the conditionals as computed before the 16kHz reference could be shared
+    ref_wav, _ = librosa.load(fpath, sr=S3GEN_SR)
+    if tts.share_ref_resample:
+        ref_16k_wav = get_resampler(S3GEN_SR, S3_SR, "cpu")(torch.from_numpy(ref_wav)[None])[0].numpy()
+    else:
+        ref_16k_wav = librosa.resample(ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
+    expected_gen = tts.s3gen.embed_ref(ref_wav[:tts.DEC_COND_LEN], S3GEN_SR, device="cpu")
+    expected_tokens, _ = tts.s3gen.tokenizer.forward([ref_16k_wav[:tts.ENC_COND_LEN]], max_len=150)
+    expected_emb = torch.from_numpy(tts.ve.embeds_from_wavs([ref_16k_wav], sample_rate=S3_SR)).mean(0, keepdim=True)
+
+    # S3Gen: the same either way
+    assert expected_gen.keys() == tts.conds.gen.keys()
+    for k, v in expected_gen.items():
+        assert torch.equal(tts.conds.gen[k], v) if torch.is_tensor(v) else tts.conds.gen[k] == v, k
+    # T3: only changes with the resampler
+    assert torch.equal(tts.conds.t3.cond_prompt_speech_tokens, expected_tokens)
+    assert torch.equal(tts.conds.t3.speaker_emb, expected_emb)
+    assert torch.equal(tts.conds.t3.emotion_adv, 0.7 * torch.ones(1, 1, 1))
+
+
+def test_prepare_conditionals_cache_hit_is_isolated(t3, s3gen, tmp_path):
+    tts = make_tts(t3, s3gen)
+    fpath = write_ref(tmp_path / "ref.wav", 4)
+    tts.prepare_conditionals(fpath, exaggeration=0.5)
+    expected = tts.conds.clone()
+
+    for exaggeration in (0.7, 0.5):
+        tts.prepare_conditionals(fpath, exaggeration=exaggeration)
+        conds = tts.conds
+        assert torch.equal(conds.t3.emotion_adv, exaggeration * torch.ones(1, 1, 1))
+        assert torch.equal(conds.t3.speaker_emb, expected.t3.speaker_emb)
+        assert torch.equal(conds.t3.cond_prompt_speech_tokens, expected.t3.cond_prompt_speech_tokens)
+        assert all(torch.equal(conds.gen[k], v) for k, v in expected.gen.items() if torch.is_tensor(v))
+        # edit the live conditionals in place, which must not reach the cached entry
+        conds.t3.speaker_emb.zero_()
+        conds.t3.cond_prompt_speech_tokens.zero_()
+        conds.gen["prompt_feat"].zero_()
+        conds.gen["embedding"].zero_()
+    assert (tts.conds_cache.hits, tts.conds_cache.misses) == (2, 1)
@@ -0,0 +1,58 @@
+import torch
+
+from chatterbox.models.s3gen.utils.mask import make_pad_mask
+
+
+def block_causal_mask(chunk_sizes, stride=1):
+    "Every frame sees the frames of its own chunk and of all the previous chunks."
+    chunk_ids = torch.repeat_interleave(torch.arange(len(chunk_sizes)), torch.tensor(chunk_sizes) * stride)
+    return (chunk_ids.unsqueeze(0) <= chunk_ids.unsqueeze(1)).unsqueeze(0)
+
+
+def block_causal_forward(encoder, xs, chunk_sizes):
+    "`UpsampleConformerEncoder.forward` of a batch of 1, with the attention masked block-causally."
+    xs_lens = torch.tensor([xs.size(1)])
+    masks = ~make_pad_mask(xs_lens, xs.size(1)).unsqueeze(1)
+    xs, pos_emb, mask_pad = encoder.embed(xs, masks)
+    xs = encoder.pre_lookahead_layer(xs)
+    xs = encoder.forward_layers(xs, block_causal_mask(chunk_sizes), pos_emb, mask_pad)
+
+    xs, xs_lens = encoder.up_layer(xs.transpose(1, 2).contiguous(), xs_lens)
+    xs = xs.transpose(1, 2).contiguous()
+    masks = ~make_pad_mask(xs_lens, xs.size(1)).unsqueeze(1)
+    xs, pos_emb, mask_pad = encoder.up_embed(xs, masks)
+    xs = encoder.forward_up_layers(xs, block_causal_mask(chunk_sizes, encoder.up_layer.stride), pos_emb, mask_pad)
+    return encoder.after_norm(xs) if encoder.normalize_before else xs
+
+
+def forward_chunks(encoder, xs, chunk_sizes):
+    "Stream `xs` through `forward_chunk`, in chunks of `chunk_sizes` frames."
+    lookahead = encoder.pre_lookahead_layer.pre_lookahead_len
+    outputs, cache, start = [], None, 0
+    for size in chunk_sizes:
+        end = start + size
+        context = xs[:, end:end + lookahead] if end < xs.size(1) else None
+        out, cache = encoder.forward_chunk(xs[:, start:end], context, cache)
+        outputs.append(out)
+        start = end
+    return torch.cat(outputs, dim=1)
+
+
+@torch.inference_mode()
+def test_single_chunk_matches_forward(s3gen):
+    encoder = s3gen.flow.encoder
+    xs = torch.randn(1, 40, 512)
+    expected, _ = encoder(xs, torch.tensor([40]))
+    assert torch.equal(forward_chunks(encoder, xs, [40]), expected)
+
+
+@torch.inference_mode()
+def test_chunks_match_block_causal_forward(s3gen):
+    encoder = s3gen.flow.encoder
+    xs = torch.randn(1, 40, 512)
+    chunk_sizes = [15, 10, 15]
+    streamed = forward_chunks(encoder, xs, chunk_sizes)
+    assert (streamed - block_causal_forward(encoder, xs, chunk_sizes)).abs().max() < 1e-5
+    # `forward` attends to the whole sequence (static_chunk_size=0), so the streamed frames are not the same
+    offline, _ = encoder(xs, torch.tensor([40]))
+    assert (streamed - offline).abs().max() > 1e-3